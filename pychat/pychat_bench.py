@@ -0,0 +1,419 @@
+# Load generator and latency benchmark for pychat_server.py and the Scratch
+# bridge (scratchat.py).
+#
+# The "server" scenario starts a local pychat server and connects many
+# simulated clients to it from this single asyncio process, with the real
+# handshake (name:, <join>). One member of each room says a timestamped
+# message at the given rate, and every member measures how long it took to
+# reach it. The "bridge" scenario starts a pychat server and a shared
+# bridge, and drives Scratch sessions over HTTP: polls, says, connect_as.
+#
+# With --compression both, each case runs plain and compressed, to compare
+# the bytes on the wire with the CPU used.
+#
+# Results are printed (or written with --output) as JSON, so that runs can
+# be compared:
+#
+#   python3 pychat_bench.py server --clients 2000 --room-sizes 10,100 --rates 10,100
+#   python3 pychat_bench.py bridge --sessions 50
+
+import argparse, asyncio, itertools, json, os, platform, resource, socket, subprocess, sys, time
+import pychat_util
+from pychat_server import raise_fd_limit
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BRIDGE_PORT = 50355 # see scratchat.py
+MARK = '~bench ' # prefix of the timed messages
+READ_BUFFER = 64 * 1024
+POLL_RATE = 30 # polls per second of Scratch 2.0
+COMPRESSION = {'off': (False,), 'on': (True,), 'both': (False, True)}
+
+
+def percentiles(samples):
+    """
+    @return: p50, p99, p999 and max of samples, in milliseconds
+    """
+    if not samples:
+        return None
+    samples = sorted(samples)
+    def at(p):
+        return round(samples[min(int(len(samples) * p), len(samples) - 1)] * 1000, 3)
+    return {'p50': at(0.50), 'p99': at(0.99), 'p999': at(0.999),
+            'max': round(samples[-1] * 1000, 3), 'count': len(samples)}
+
+
+def process_usage(pid):
+    """
+    @return: CPU seconds used so far and resident memory of a process
+             (Linux only, None elsewhere)
+    """
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/%d/status' % pid) as f:
+            rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    except (OSError, StopIteration, IndexError):
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    return {'cpu_s': (int(fields[11]) + int(fields[12])) / ticks, 'rss_kb': rss}
+
+
+def usage_delta(before, after):
+    if before is None or after is None:
+        return after
+    return {'cpu_s': round(after['cpu_s'] - before['cpu_s'], 3), 'rss_kb': after['rss_kb']}
+
+
+def self_usage():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {'cpu_s': usage.ru_utime + usage.ru_stime, 'rss_kb': usage.ru_maxrss}
+
+
+def start_process(args, cwd, port):
+    """
+    Start a server and wait until it accepts connections on port.
+    """
+    proc = subprocess.Popen([sys.executable] + args, cwd=cwd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                sys.exit('could not start: ' + ' '.join(args))
+            time.sleep(0.1)
+
+
+def stop_process(proc):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def start_chat_server(opts):
+    args = ['pychat_server.py', '127.0.0.1', '--engine', opts.engine,
+            '--framing', opts.framing, '--backlog', '4096',
+            # measure the server, not its flood control
+            '--flood-rate', '0', '--room-rate', '0'] + opts.server_arg
+    return start_process(args, HERE, pychat_util.PORT)
+
+
+class Client:
+    """
+    One simulated chat client.
+    """
+
+    def __init__(self, name, codec):
+        self.name = name
+        self.codec = codec
+        self.decoder = codec.decoder()
+        self.compressor = None
+        self.decompressor = None
+        self.latencies = None # list to record the latencies into
+        self.received = 0
+        self.wire_bytes = 0 # received, compressed or not
+
+    async def connect(self, room_name, compress=False):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', pychat_util.PORT)
+        # timed messages leave at once, instead of waiting for an ACK (Nagle)
+        self.writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        await self.wait_for('Please tell us your name')
+        if compress:
+            await self.compress()
+        self.send('name: ' + self.name)
+        self.send('<join> ' + room_name)
+        await self.wait_for(room_name + ' welcomes: ' + self.name)
+
+    async def compress(self):
+        self.send(pychat_util.COMPRESS_COMMAND)
+        ack = self.codec.encode(pychat_util.COMPRESS_ACK)
+        buffer = b''
+        while ack not in buffer:
+            buffer += await self.read()
+        self.compressor = pychat_util.new_compressor()
+        self.decompressor = pychat_util.new_decompressor()
+        self.decoder.feed(self.inflate(buffer[buffer.index(ack) + len(ack):]))
+
+    async def read(self):
+        data = await self.reader.read(READ_BUFFER)
+        if not data:
+            raise ConnectionError(self.name + ': server closed the connection')
+        self.wire_bytes += len(data)
+        return data
+
+    def inflate(self, data):
+        if self.decompressor is None:
+            return data
+        return pychat_util.inflate(self.decompressor, data)
+
+    async def wait_for(self, text):
+        while True:
+            if any(text in msg for msg in self.decoder.feed(self.inflate(await self.read()))):
+                return
+
+    def send(self, msg):
+        data = self.codec.encode(msg)
+        if self.compressor is not None:
+            data = pychat_util.compress_frames(self.compressor, [data])
+        self.writer.write(data)
+
+    async def receive(self):
+        while True:
+            try:
+                data = self.inflate(await self.read())
+            except ConnectionError:
+                return
+            now = time.perf_counter()
+            for msg in self.decoder.feed(data):
+                text = msg.partition(':')[2]
+                if text.startswith(MARK):
+                    self.received += 1
+                    if self.latencies is not None:
+                        self.latencies.append(now - float(text[len(MARK):]))
+
+    def close(self):
+        self.writer.close()
+
+
+async def send_at_rate(clients, rate, duration, phase, counter):
+    """
+    Say timed messages in a room, rate per second, from its members in turn.
+    @param phase: Fraction of the interval to wait first, so that the rooms
+                  do not all send at the same time
+    """
+    interval = 1 / rate
+    await asyncio.sleep(phase * interval)
+    start = time.perf_counter()
+    sent = 0
+    senders = itertools.cycle(clients)
+    while True:
+        now = time.perf_counter()
+        if now - start >= duration:
+            break
+        due = int((now - start) / interval) + 1 # catch up when late
+        while sent < due:
+            next(senders).send(MARK + repr(time.perf_counter()))
+            sent += 1
+        await asyncio.sleep(start + sent * interval - time.perf_counter())
+    counter.append(sent)
+
+
+async def run_server_case(opts, run, room_size, rate, compress, server_pid):
+    codec = pychat_util.CODECS[opts.framing]
+    rooms = max(opts.clients // room_size, 1)
+    clients = []
+    for room in range(rooms):
+        for i in range(room_size):
+            client = Client('b%d_%d_%d' % (run, room, i), codec)
+            clients.append((client, 'bench%d_%d' % (run, room)))
+    # connect in batches, not to overflow the listen backlog
+    for start in range(0, len(clients), 200):
+        await asyncio.gather(*(client.connect(room_name, compress)
+                               for client, room_name in clients[start:start + 200]))
+    latencies = []
+    for client, room_name in clients:
+        client.latencies = latencies
+        client.wire_bytes = 0
+    readers = [asyncio.ensure_future(client.receive()) for client, room_name in clients]
+
+    server_before, self_before = process_usage(server_pid), self_usage()
+    counter = []
+    started = time.perf_counter()
+    await asyncio.gather(*(send_at_rate([c for c, _ in clients[r * room_size:(r + 1) * room_size]],
+                                        rate, opts.duration, r / rooms, counter)
+                           for r in range(rooms)))
+    await asyncio.sleep(opts.drain) # let the last messages arrive
+    elapsed = time.perf_counter() - started
+    server_after, self_after = process_usage(server_pid), self_usage()
+
+    for client, room_name in clients:
+        client.close()
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+    await asyncio.sleep(0.5) # let the server drop them
+
+    sent = sum(counter)
+    received = sum(client.received for client, room_name in clients)
+    wire_bytes = sum(client.wire_bytes for client, room_name in clients)
+    return {
+        'room_size': room_size, 'rate': rate, 'compress': compress,
+        'rooms': rooms, 'clients': len(clients),
+        'sent': sent, 'expected': sent * room_size, 'received': received,
+        'sent_per_s': round(sent / opts.duration, 1),
+        'received_per_s': round(received / elapsed, 1),
+        # bandwidth, to compare with the CPU used by the server
+        'wire_bytes': wire_bytes,
+        'wire_bytes_per_message': round(wire_bytes / received, 1) if received else None,
+        'latency_ms': percentiles(latencies),
+        'server': usage_delta(server_before, server_after),
+        'bench': usage_delta(self_before, self_after),
+    }
+
+
+async def bench_server(opts):
+    proc = start_chat_server(opts)
+    results = []
+    try:
+        run = itertools.count()
+        for room_size in opts.room_sizes:
+            for rate in opts.rates:
+                for compress in COMPRESSION[opts.compression]:
+                    result = await run_server_case(opts, next(run), room_size, rate,
+                                                   compress, proc.pid)
+                    print(json.dumps(result), file=sys.stderr)
+                    results.append(result)
+    finally:
+        stop_process(proc)
+    return results
+
+
+class HttpClient:
+    """
+    Minimal HTTP/1.1 keep-alive client, as Scratch uses it.
+    """
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection('127.0.0.1', BRIDGE_PORT)
+
+    async def get(self, path):
+        self.writer.write(('GET %s HTTP/1.1\r\nHost: localhost\r\n\r\n' % path).encode())
+        headers = await self.reader.readuntil(b'\r\n\r\n')
+        length = 0
+        for line in headers.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.lower() == b'content-length':
+                length = int(value)
+        return await self.reader.readexactly(length)
+
+    def close(self):
+        self.writer.close()
+
+
+async def run_session(opts, session, timings, stop):
+    prefix = '/session/s%d/' % session
+    http = HttpClient()
+    await http.connect()
+
+    async def timed(command, path):
+        start = time.perf_counter()
+        await http.get(prefix + path)
+        timings.setdefault(command, []).append(time.perf_counter() - start)
+
+    await timed('connect_as', 'connect_as/bench%d' % session)
+    await timed('join_room', 'join_room/bench%d' % (session % opts.rooms))
+    next_say = time.perf_counter()
+    says = itertools.count()
+    while not stop.is_set():
+        await timed('poll', 'poll')
+        if opts.say_rate and time.perf_counter() >= next_say:
+            await timed('say', 'say/hello%20' + str(next(says)))
+            next_say += 1 / opts.say_rate
+        await asyncio.sleep(1 / POLL_RATE)
+    await timed('reset_all', 'reset_all')
+    http.close()
+
+
+async def bench_bridge(opts):
+    chat_server = start_chat_server(opts)
+    bridge = None
+    try:
+        # the bridge writes its log directory in its working directory
+        bridge = start_process([os.path.join(os.path.dirname(HERE), 'scratchat.py'), '127.0.0.1',
+                                '--shared', '--links', str(opts.links)],
+                               opts.workdir, BRIDGE_PORT)
+        timings = {}
+        stop = asyncio.Event()
+        bridge_before = process_usage(bridge.pid)
+        started = time.perf_counter()
+        sessions = [asyncio.ensure_future(run_session(opts, session, timings, stop))
+                    for session in range(opts.sessions)]
+        await asyncio.sleep(opts.duration)
+        stop.set()
+        await asyncio.gather(*sessions)
+        elapsed = time.perf_counter() - started
+        bridge_after = process_usage(bridge.pid)
+    finally:
+        if bridge is not None:
+            stop_process(bridge)
+        stop_process(chat_server)
+    requests = sum(len(samples) for samples in timings.values())
+    return [{
+        'sessions': opts.sessions, 'rooms': opts.rooms, 'say_rate': opts.say_rate,
+        'links': opts.links, 'requests': requests,
+        'requests_per_s': round(requests / elapsed, 1),
+        'latency_ms': {command: percentiles(samples) for command, samples in timings.items()},
+        'bridge': usage_delta(bridge_before, bridge_after),
+    }]
+
+
+def int_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pychat benchmark')
+    parser.add_argument('scenario', choices=('server', 'bridge'))
+    parser.add_argument('--duration', type=float, default=10,
+                        help="seconds of load in each run (default: %(default)s)")
+    parser.add_argument('--drain', type=float, default=1,
+                        help="seconds to wait for late messages (default: %(default)s)")
+    parser.add_argument('--engine', default='asyncio',
+                        help="engine of the server (default: %(default)s)")
+    parser.add_argument('--framing', choices=sorted(pychat_util.CODECS), default='newline')
+    parser.add_argument('--server-arg', action='append', default=[],
+                        help="more arguments for pychat_server.py, may be repeated")
+    parser.add_argument('--output', help="write the JSON results to this file")
+    group = parser.add_argument_group('server scenario')
+    group.add_argument('--clients', type=int, default=1000,
+                       help="connections in each run (default: %(default)s)")
+    group.add_argument('--room-sizes', type=int_list, default=[10, 100],
+                       help="comma separated room sizes (default: 10,100)")
+    group.add_argument('--rates', type=int_list, default=[10, 100],
+                       help="comma separated messages per second and per room (default: 10,100)")
+    group.add_argument('--compression', choices=sorted(COMPRESSION), default='off',
+                       help="compressed connections; both compares bandwidth and CPU "
+                            "(default: %(default)s)")
+    group = parser.add_argument_group('bridge scenario')
+    group.add_argument('--sessions', type=int, default=20,
+                       help="Scratch sessions, each polling %d times per second "
+                            "(default: %%(default)s)" % POLL_RATE)
+    group.add_argument('--rooms', type=int, default=2,
+                       help="rooms the sessions are spread over (default: %(default)s)")
+    group.add_argument('--say-rate', type=float, default=1,
+                       help="messages per second said by each session (default: %(default)s)")
+    group.add_argument('--links', type=int, default=1,
+                       help="connections of the bridge to the server (default: %(default)s)")
+    group.add_argument('--workdir', default='.',
+                       help="working directory of the bridge, for its log (default: .)")
+    opts = parser.parse_args()
+
+    raise_fd_limit()
+    if opts.scenario == 'server':
+        results = asyncio.run(bench_server(opts))
+    else:
+        results = asyncio.run(bench_bridge(opts))
+    report = {
+        'scenario': opts.scenario,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': {name: value for name, value in vars(opts).items() if name != 'output'},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if opts.output:
+        with open(opts.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
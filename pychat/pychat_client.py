@@ -1,3 +1,4 @@
+import argparse
 import select
 import socket
 import sys
@@ -5,13 +6,19 @@ import pychat_util
 
 READ_BUFFER = 4096
 
-if len(sys.argv) < 2:
-    print("Usage: Python3 client.py [hostname]", file=sys.stderr)
-    sys.exit(1)
-else:
-    server_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_connection.connect((sys.argv[1], pychat_util.PORT))
+parser = argparse.ArgumentParser(description='pychat client')
+parser.add_argument('hostname')
+parser.add_argument('--framing', choices=sorted(pychat_util.CODECS), default='newline',
+                    help="message framing, must match the server (default: %(default)s)")
+parser.add_argument('--compress', action='store_true',
+                    help="ask the server to compress the connection")
+args = parser.parse_args()
+
+codec = pychat_util.CODECS[args.framing]
+decoder = codec.decoder()
+server_connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+server_connection.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+server_connection.connect((args.hostname, pychat_util.PORT))
 
 
 def prompt():
@@ -20,6 +27,40 @@ def prompt():
 
 print("Connected to server\n")
 msg_prefix = ''
+compress_asked = False
+
+
+def compress():
+    """
+    Ask the server to compress the connection, before telling our name.
+    """
+    global server_connection, compress_asked
+    compress_asked = True
+    server_connection.sendall(codec.encode(pychat_util.COMPRESS_COMMAND))
+    accepted, received = pychat_util.read_answer(server_connection, codec,
+                                                 pychat_util.COMPRESS_ACK)
+    if accepted: # else an older server answered as to a message, ignore it
+        server_connection = pychat_util.CompressedSocket(server_connection, received)
+        socket_list[1] = server_connection
+
+
+def receive(data):
+    global msg_prefix
+    msgs = decoder.feed(data)
+    for msg in msgs:
+        if msg == pychat_util.QUIT_STRING:
+            sys.stdout.write('Bye\n')
+            sys.exit(2)
+        sys.stdout.write(msg + '\n')
+        if 'Please tell us your name' in msg:
+            msg_prefix = 'name: '  # identifier for name
+            if args.compress and not compress_asked:
+                compress()
+        else:
+            msg_prefix = ''
+    if msgs:
+        prompt()
+
 
 socket_list = [sys.stdin, server_connection]
 
@@ -28,22 +69,12 @@ while True:
         select.select(socket_list, [], [])
     for s in read_sockets:
         if s is server_connection:  # incoming message
-            msg = s.recv(READ_BUFFER)
-            if not msg:
+            data = s.recv(READ_BUFFER)
+            if not data:
                 print("Server down!")
                 sys.exit(2)
-            else:
-                if msg == pychat_util.QUIT_STRING.encode():
-                    sys.stdout.write('Bye\n')
-                    sys.exit(2)
-                else:
-                    sys.stdout.write(msg.decode())
-                    if 'Please tell us your name' in msg.decode():
-                        msg_prefix = 'name: '  # identifier for name
-                    else:
-                        msg_prefix = ''
-                    prompt()
+            receive(data)
 
         else:
-            msg = msg_prefix + sys.stdin.readline()
-            server_connection.sendall(msg.encode())
+            msg = msg_prefix + sys.stdin.readline().rstrip('\n')
+            server_connection.sendall(codec.encode(msg))
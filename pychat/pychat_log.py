@@ -0,0 +1,272 @@
+# Durable, append-only log of the messages said in each room.
+#
+# Each room has its own directory, made of segment files named after the
+# sequence number of their first message. A record is a 4-byte big-endian
+# length followed by the frame, as it was sent to the players. Messages are
+# written by a background thread, so logging never delays a broadcast, and
+# read back through mmap so that a long history is sent without copying it.
+
+import bisect, itertools, logging, mmap, os, queue, struct, threading, time
+from urllib import parse
+
+SEGMENT_BYTES = 4 * 1024 * 1024 # start a new segment past this size
+FSYNC_INTERVAL = 1.0 # seconds, 0 to fsync every batch, < 0 to never fsync
+SEGMENT_SUFFIX = '.log'
+HEADER = struct.Struct('!I')
+
+log = logging.getLogger('pychat.log')
+
+
+class Segment:
+    """
+    One segment file, with the offsets of its records.
+    """
+
+    def __init__(self, path, first_seq):
+        self.path = path
+        self.first_seq = first_seq
+        self.offsets = [] # offset of each record, filled by the writer
+        self.size = 0
+        self.map = None
+
+    def scan(self):
+        """
+        Rebuild the offset index of an existing segment. A record cut by a
+        crash is ignored, and overwritten by the next one.
+        """
+        self.offsets = []
+        end = os.path.getsize(self.path)
+        if end:
+            with open(self.path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            pos = 0
+            while pos + HEADER.size <= end:
+                length, = HEADER.unpack_from(data, pos)
+                if pos + HEADER.size + length > end:
+                    break
+                self.offsets.append(pos)
+                pos += HEADER.size + length
+            end = pos
+        self.size = end
+
+    def view(self, index):
+        """
+        Return a memoryview on record index, without copying it. The record
+        ends where its own header says: the writer thread may be appending
+        records after it meanwhile.
+        """
+        start = self.offsets[index] + HEADER.size
+        if self.map is None or len(self.map) < start:
+            self.remap()
+        end = start + HEADER.unpack_from(self.map, start - HEADER.size)[0]
+        if len(self.map) < end:
+            self.remap()
+        return memoryview(self.map)[start:end]
+
+    def remap(self):
+        # the active segment grew since it was mapped
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class RoomLog:
+    """
+    The log of one room. append() is called by the server loop, and only
+    queues the frame for the writer thread of the MessageLog.
+    """
+
+    def __init__(self, message_log, directory):
+        self.message_log = message_log
+        self.directory = directory
+        self.segments = []
+        self.file = None # active segment, opened by the writer
+        os.makedirs(directory, exist_ok=True)
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(SEGMENT_SUFFIX):
+                first_seq = int(filename[:-len(SEGMENT_SUFFIX)])
+                self.segments.append(Segment(os.path.join(directory, filename), first_seq))
+        if self.segments:
+            self.segments[-1].scan() # older segments are scanned when read
+            self.next_seq = self.segments[-1].first_seq + len(self.segments[-1].offsets)
+        else:
+            self.next_seq = 0
+        self.written_seq = self.next_seq # messages before this one are on disk
+
+    def append(self, frame):
+        self.message_log.queue.put((self, frame))
+        self.next_seq += 1
+
+    def read(self, end_seq, count):
+        """
+        Return up to count frames (as memoryviews on the segment files)
+        of the messages just before end_seq, oldest first.
+        """
+        end_seq = min(end_seq, self.written_seq)
+        seq = max(end_seq - count, 0)
+        firsts = [segment.first_seq for segment in self.segments]
+        i = max(bisect.bisect_right(firsts, seq) - 1, 0)
+        frames = []
+        while seq < end_seq and i < len(self.segments):
+            segment = self.segments[i]
+            if not segment.offsets and segment is not self.segments[-1]:
+                segment.scan()
+            index = seq - segment.first_seq
+            if 0 <= index < len(segment.offsets):
+                frames.append(segment.view(index))
+                seq += 1
+            elif index < 0: # hole, e.g. after a crash
+                seq = segment.first_seq
+            else:
+                i += 1
+        return frames
+
+    def write(self, frames):
+        """
+        Called by the writer thread with a batch of frames for this room.
+        """
+        segment_bytes = self.message_log.segment_bytes
+        start = 0
+        while start < len(frames):
+            if self.file is None or self.segments[-1].size >= segment_bytes:
+                self.rotate()
+            segment = self.segments[-1]
+            data = bytearray()
+            offsets = []
+            for frame in itertools.islice(frames, start, None):
+                if offsets and segment.size + len(data) >= segment_bytes:
+                    break # the rest goes to the next segment
+                offsets.append(segment.size + len(data))
+                data += HEADER.pack(len(frame))
+                data += frame
+            self.file.write(data)
+            self.file.flush()
+            segment.offsets.extend(offsets)
+            segment.size += len(data)
+            self.written_seq += len(offsets)
+            start += len(offsets)
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+        if not self.segments or self.segments[-1].size >= self.message_log.segment_bytes:
+            path = os.path.join(self.directory, '%020d%s' % (self.written_seq, SEGMENT_SUFFIX))
+            self.segments.append(Segment(path, self.written_seq))
+        segment = self.segments[-1]
+        self.file = open(segment.path, 'r+b' if os.path.exists(segment.path) else 'wb')
+        self.file.truncate(segment.size) # drop a record cut by a crash
+        self.file.seek(segment.size)
+
+    def sync(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class MessageLog:
+    """
+    Logs of all the rooms, under one directory. A single writer thread
+    takes the queued frames in batches, writes each room's share of the
+    batch in one call, and fsyncs every fsync_interval seconds.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, fsync_interval=FSYNC_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.rooms = {} # {room_name: RoomLog}
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.run, name='pychat-log', daemon=True)
+        self.thread.start()
+
+    def room(self, room_name):
+        room_log = self.rooms.get(room_name)
+        if room_log is None:
+            # room names come from the users: make them safe as a directory name
+            safe_name = parse.quote(room_name, safe='').replace('.', '%2E')
+            directory = os.path.join(self.directory, safe_name)
+            room_log = self.rooms[room_name] = RoomLog(self, directory)
+        return room_log
+
+    def release(self, room_name):
+        """
+        Forget the log of a room that was dropped: the writer closes its
+        file. Its segments stay mapped while frames read from them are
+        still queued for players.
+        """
+        room_log = self.rooms.pop(room_name, None)
+        if room_log is not None:
+            self.queue.put((room_log, None))
+
+    def sync(self):
+        """
+        Wait until what is queued is written and synced to disk, e.g. before
+        another process reads the logs.
+        """
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def run(self):
+        dirty = set()
+        last_sync = time.monotonic()
+        while True:
+            timeout = None
+            if dirty and self.fsync_interval > 0:
+                timeout = max(last_sync + self.fsync_interval - time.monotonic(), 0)
+            try:
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            while True: # take whatever else is already queued
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in batch
+            by_room = {}
+            released = []
+            synced = []
+            for item in batch:
+                if item is None:
+                    continue
+                if isinstance(item, threading.Event):
+                    synced.append(item)
+                    continue
+                if item[1] is None:
+                    released.append(item[0])
+                else:
+                    by_room.setdefault(item[0], []).append(item[1])
+            for room_log, frames in by_room.items():
+                try:
+                    room_log.write(frames)
+                except OSError as e:
+                    log.error("Could not write the log of %s: %s", room_log.directory, e)
+                dirty.add(room_log)
+            for room_log in released:
+                if room_log in dirty:
+                    room_log.sync()
+                    dirty.discard(room_log)
+                room_log.close()
+            if self.fsync_interval >= 0 and dirty and \
+                    (stop or synced or time.monotonic() - last_sync >= self.fsync_interval):
+                for room_log in dirty:
+                    room_log.sync()
+                dirty.clear()
+                last_sync = time.monotonic()
+            for done in synced:
+                done.set()
+            if stop:
+                for room_log in self.rooms.values():
+                    room_log.close()
+                return
+
+    def close(self):
+        """
+        Write out what is still queued, and stop the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
@@ -0,0 +1,164 @@
+# Logging pipeline of the server and of the Scratch bridge.
+#
+# The loggers only put records on a queue: a listener thread formats them
+# and writes them to the console (and to a file), so that logging never
+# does I/O on the path of a message. Records are formatted by the listener,
+# not by the thread that logged them, so log calls must pass their values as
+# arguments (log.info('%s says: %s', name, msg)), never pre-formatted.
+#
+# Each category (logger name) can have its own level, and chatty ones can
+# be sampled: past a number of records per second, the rest are dropped and
+# counted.
+#
+# This module is also imported by the bridge: it must not import the
+# other pychat modules.
+
+import argparse, logging, logging.handlers, queue, sys, time
+
+CONSOLE_FORMAT = '%(message)s'
+FILE_FORMAT = '%(asctime)s %(name)s %(levelname)s: %(message)s'
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue the record as it is: the listener formats it.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Let at most rate records per second through (token bucket, bursts of
+    up to rate records). The next record let through tells how many were
+    dropped.
+    """
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+        self.tokens -= 1
+        if self.dropped:
+            record.msg = str(record.msg) + ' [%d dropped]' % self.dropped
+            self.dropped = 0
+        return True
+
+
+def setup(console_level=logging.INFO, log_file=None, file_level=logging.DEBUG,
+          file_mode='a', levels=None, sample=None):
+    """
+    Send the records of every logger of the process through a queue to a
+    listener thread. Call again after a fork: the thread is not copied.
+    @param levels: {category: level}
+    @param sample: {category: records per second}
+    @return: The listener, to stop() before exiting (it writes out what
+             is still queued)
+    """
+    handlers = []
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(console_level)
+    console.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+    handlers.append(console)
+    level = console_level
+    if log_file:
+        file_handler = logging.FileHandler(log_file, mode=file_mode)
+        file_handler.setLevel(file_level)
+        file_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+        handlers.append(file_handler)
+        level = min(level, file_level)
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(LazyQueueHandler(records))
+    root.setLevel(level) # records nobody would write are not even created
+
+    for category, category_level in (levels or {}).items():
+        logging.getLogger(category).setLevel(category_level)
+    for category, rate in (sample or {}).items():
+        logger = logging.getLogger(category)
+        for old in [f for f in logger.filters if isinstance(f, SamplingFilter)]:
+            logger.removeFilter(old)
+        if rate > 0:
+            logger.addFilter(SamplingFilter(rate))
+
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def category_value(convert):
+    """
+    argparse type of command-line values such as 'pychat.messages=WARNING',
+    so that a bad one is a usage error.
+    @return: Function parsing one value into (category, convert(value))
+    """
+    def parse(pair):
+        category, sep, value = pair.rpartition('=')
+        try:
+            if not sep:
+                raise ValueError('expected CATEGORY=VALUE')
+            return category, convert(value)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError('%s: %s' % (pair, e))
+    return parse
+
+
+def category_values(pairs):
+    """
+    @param pairs: [(category, value)] parsed by category_value
+    @return: {category: value}
+    """
+    return dict(pairs)
+
+
+def level(value):
+    if value.isdigit():
+        return int(value)
+    number = logging.getLevelName(value.upper())
+    if not isinstance(number, int): # 'Level FOO'
+        raise ValueError('unknown level ' + value)
+    return number
+
+
+def sample_rate(value):
+    rate = float(value)
+    if rate < 0:
+        raise ValueError('negative rate')
+    return rate
+
+
+def add_arguments(parser, sample):
+    """
+    Add the logging options to an argparse parser.
+    @param sample: Default {category: records per second}
+    """
+    parser.add_argument('--log-level', action='append', default=[], metavar='CATEGORY=LEVEL',
+                        type=category_value(level),
+                        help="level of a log category, e.g. pychat.messages=WARNING, "
+                             "may be repeated")
+    parser.add_argument('--log-sample', action='append', default=[], metavar='CATEGORY=N',
+                        type=category_value(sample_rate),
+                        help="at most N records per second of a category, 0 for no "
+                             "limit (default: %s)" % ', '.join(
+                                 '%s=%s' % item for item in sorted(sample.items())))
+    parser.set_defaults(log_sample_defaults=sample)
+
+
+def setup_from_args(args, **options):
+    sample = dict(args.log_sample_defaults)
+    sample.update(category_values(args.log_sample))
+    return setup(levels=category_values(args.log_level), sample=sample, **options)
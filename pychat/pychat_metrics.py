@@ -0,0 +1,327 @@
+# Live metrics of the server: counters and histograms updated by the server
+# loop, reported by the <stats> command and, optionally, on a local HTTP
+# endpoint in the Prometheus text format.
+#
+# Updating them costs a few additions per message. Reports are built only
+# when asked for; the HTTP endpoint runs in its own thread and reads copies
+# of the hall's dicts, so it never stops the server loop.
+
+import bisect, logging, sys, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pychat_util
+
+# upper bounds of the histogram buckets, in seconds
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+                0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+RATE_WINDOW = 60 # seconds over which the message rate of a room is measured
+BYTES_OBJECT = sys.getsizeof(b'') # overhead of each queued frame
+BYTES_ZLIB = 300 * 1024 # estimate for the zlib streams of a compressed player
+
+log = logging.getLogger('pychat.metrics')
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, as in Prometheus.
+    """
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q quantile (None if empty,
+        inf past the last bucket).
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class RateMeter:
+    """
+    Events per second over the last RATE_WINDOW seconds, counted in
+    one-second slots.
+    """
+
+    __slots__ = ('stamps', 'counts', 'total')
+
+    def __init__(self, window=RATE_WINDOW):
+        self.stamps = [0] * window # second counted by each slot
+        self.counts = [0] * window
+        self.total = 0
+
+    def mark(self, now):
+        second = int(now)
+        slot = second % len(self.counts)
+        if self.stamps[slot] != second:
+            self.stamps[slot] = second
+            self.counts[slot] = 0
+        self.counts[slot] += 1
+        self.total += 1
+
+    def rate(self, now):
+        second = int(now)
+        window = len(self.counts)
+        return sum(count for stamp, count in zip(self.stamps, self.counts)
+                   if 0 <= second - stamp < window) / window
+
+
+class Metrics:
+    """
+    Metrics of one Hall (set as hall.metrics), fed by the Hall and the
+    server engines.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.connections = 0 # accepted, including multiplexed channels
+        self.disconnections = 0
+        self.bytes_in = 0
+        self.rooms = {} # {room_name: RateMeter} of the messages said
+        self.commands = {} # {command: Histogram} of the time spent
+        self.loop = Histogram() # busy time of each loop iteration
+        self.rate_limited = {'player': 0, 'room': 0} # messages over the flood limits
+        self.rooms_reaped = 0
+
+    def message(self, room_name):
+        meter = self.rooms.get(room_name)
+        if meter is None:
+            meter = self.rooms[room_name] = RateMeter()
+        meter.mark(time.monotonic())
+
+    def command(self, command, seconds):
+        histogram = self.commands.get(command)
+        if histogram is None:
+            histogram = self.commands[command] = Histogram()
+        histogram.observe(seconds)
+
+    def limited(self, scope):
+        self.rate_limited[scope] += 1
+
+    def reaped(self, room_name):
+        self.rooms_reaped += 1
+        self.rooms.pop(room_name, None)
+
+    def snapshot(self, hall):
+        """
+        Copy what the reports need, so that they can be built out of the
+        server loop. Gauges are computed here rather than updated for
+        every message.
+        """
+        players = list(hall.players.values())
+        rooms = list(hall.rooms.values())
+        outbound = [player.outbox.size for player in players]
+        now = time.monotonic()
+        meters = dict(self.rooms)
+        return {
+            'uptime': now - self.started,
+            'players': len(players),
+            'rooms': [(room.name, len(room.players)) for room in rooms],
+            'empty_rooms': len(hall.empty_rooms),
+            'meters': meters,
+            'room_bytes': sum(room_bytes(room, meters.get(room.name)) for room in rooms),
+            'player_bytes': sum(player_bytes(player) for player in players),
+            'commands': sorted(self.commands.items()),
+            'outbound': sum(outbound),
+            'outbound_max': max(outbound, default=0),
+            'now': now,
+        }
+
+    def report(self, hall):
+        """
+        @return: Summary for the <stats> command
+        """
+        s = self.snapshot(hall)
+        io = hall.io_stats
+        lines = [
+            'Uptime: %ds, %d player(s) in %d room(s)' % (s['uptime'], s['players'], len(s['rooms'])),
+            'Connections: %d accepted, %d closed' % (self.connections, self.disconnections),
+            'Bytes: %d in, %d out (%s)' % (self.bytes_in, io.bytes, io),
+            'Outbound queues: %d bytes, largest %d' % (s['outbound'], s['outbound_max']),
+            'Loop iteration: %s' % format_histogram(self.loop),
+            'Rooms: %d empty, %d reaped' % (s['empty_rooms'], self.rooms_reaped),
+            'Memory: %d bytes in rooms (%d per room), %d bytes in players (%d per player)' % (
+                s['room_bytes'], s['room_bytes'] / max(len(s['rooms']), 1),
+                s['player_bytes'], s['player_bytes'] / max(s['players'], 1)),
+            'Rate limited: %d over a player limit, %d over a room limit' % (
+                self.rate_limited['player'], self.rate_limited['room']),
+        ]
+        for name, count in s['rooms']:
+            meter = s['meters'].get(name)
+            lines.append('Room %s: %d player(s), %d message(s), %.2f msg/s' % (
+                name, count, meter.total if meter else 0,
+                meter.rate(s['now']) if meter else 0))
+        for command, histogram in s['commands']:
+            lines.append('Command %s: %s' % (command, format_histogram(histogram)))
+        return '\n'.join(lines)
+
+    def prometheus(self, hall):
+        """
+        @return: All the metrics in the Prometheus text format
+        """
+        s = self.snapshot(hall)
+        io = hall.io_stats
+        out = []
+
+        def metric(name, kind, help_text, samples):
+            out.append('# HELP pychat_%s %s' % (name, help_text))
+            out.append('# TYPE pychat_%s %s' % (name, kind))
+            for labels, value in samples:
+                out.append('pychat_%s%s %s' % (name, labels, value))
+
+        def histogram_samples(histogram, label=''):
+            samples = []
+            seen = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                seen += count
+                samples.append(('_bucket{%sle="%s"}' % (label, bound), seen))
+            seen += histogram.counts[-1] # consistent with the buckets, unlike count
+            samples.append(('_bucket{%sle="+Inf"}' % label, seen))
+            labels = '{%s}' % label[:-1] if label else ''
+            samples.append(('_sum' + labels, histogram.sum))
+            samples.append(('_count' + labels, seen))
+            return samples
+
+        metric('uptime_seconds', 'gauge', 'Seconds since the server started',
+               [('', round(s['uptime'], 3))])
+        metric('connections_total', 'counter', 'Connections accepted',
+               [('', self.connections)])
+        metric('disconnections_total', 'counter', 'Connections closed',
+               [('', self.disconnections)])
+        metric('players', 'gauge', 'Players connected', [('', s['players'])])
+        metric('rooms', 'gauge', 'Rooms, empty ones included', [('', len(s['rooms']))])
+        metric('empty_rooms', 'gauge', 'Rooms without players, not reaped yet',
+               [('', s['empty_rooms'])])
+        metric('rooms_reaped_total', 'counter', 'Empty rooms dropped', [('', self.rooms_reaped)])
+        metric('room_memory_bytes', 'gauge', 'Estimated memory used by the rooms',
+               [('', s['room_bytes'])])
+        metric('player_memory_bytes', 'gauge', 'Estimated memory used by the players',
+               [('', s['player_bytes'])])
+        metric('room_players', 'gauge', 'Players in each room',
+               [('{room="%s"}' % escape(name), count) for name, count in s['rooms']])
+        metric('messages_total', 'counter', 'Messages said in each room',
+               [('{room="%s"}' % escape(name), meter.total) for name, meter in s['meters'].items()])
+        metric('message_rate', 'gauge',
+               'Messages per second in each room, over the last %d seconds' % RATE_WINDOW,
+               [('{room="%s"}' % escape(name), meter.rate(s['now']))
+                for name, meter in s['meters'].items()])
+        metric('rate_limited_total', 'counter',
+               'Messages dropped for going over the flood limit of a player or of a room',
+               [('{scope="%s"}' % scope, count) for scope, count in sorted(self.rate_limited.items())])
+        metric('received_bytes_total', 'counter', 'Bytes received from the clients',
+               [('', self.bytes_in)])
+        metric('sent_bytes_total', 'counter', 'Bytes sent to the clients', [('', io.bytes)])
+        metric('sent_frames_total', 'counter', 'Messages sent to the clients', [('', io.frames)])
+        metric('writes_total', 'counter', 'Write system calls', [('', io.writes)])
+        metric('outbound_bytes', 'gauge', 'Bytes queued for the clients', [('', s['outbound'])])
+        metric('outbound_max_bytes', 'gauge', 'Bytes queued for the slowest client',
+               [('', s['outbound_max'])])
+        metric('loop_iteration_seconds', 'histogram', 'Busy time of each loop iteration',
+               histogram_samples(self.loop))
+        samples = []
+        for command, histogram in s['commands']:
+            samples += histogram_samples(histogram, 'command="%s",' % escape(command))
+        metric('command_seconds', 'histogram', 'Time spent handling each command', samples)
+        return '\n'.join(out) + '\n'
+
+
+def room_bytes(room, meter=None):
+    """
+    Estimated memory used by a room: its objects, history and meter. It
+    is read out of the server loop, so nothing here iterates over what
+    the loop may change.
+    """
+    history = room.history
+    size = (sys.getsizeof(room) + sys.getsizeof(room.name) + sys.getsizeof(room.players)
+            + sys.getsizeof(history) + sys.getsizeof(history.frames)
+            + history.bytes + BYTES_OBJECT * len(history.frames))
+    if room.bucket is not None:
+        size += sys.getsizeof(room.bucket)
+    matcher = room.matcher
+    if matcher is not None:
+        size += sum(sys.getsizeof(part) for part in (
+            matcher, matcher.filters, matcher.subscribers, matcher.keys,
+            matcher.goto, matcher.ends, matcher.fail, matcher.found))
+        size += len(matcher.goto) * sys.getsizeof({}) # the nodes, roughly
+    if meter is not None:
+        size += sys.getsizeof(meter) + sys.getsizeof(meter.stamps) + sys.getsizeof(meter.counts)
+    return size
+
+
+def player_bytes(player):
+    """
+    Estimated memory used by a player: its objects, and its buffers.
+    """
+    size = sys.getsizeof(player) + sys.getsizeof(player.name)
+    buffer = getattr(player.decoder, 'buffer', None)
+    if buffer is not None:
+        size += sys.getsizeof(buffer)
+    if player.bucket is not None:
+        size += sys.getsizeof(player.bucket)
+    outbox = player.outbox
+    if outbox is not pychat_util.NO_OUTBOX: # shared by the multiplexed channels
+        size += (sys.getsizeof(outbox) + sys.getsizeof(outbox.chunks)
+                 + outbox.size + BYTES_OBJECT * len(outbox.chunks))
+    if player.decompressor is not None:
+        size += BYTES_ZLIB
+    return size
+
+
+def escape(label):
+    return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_histogram(histogram):
+    if not histogram.count:
+        return 'none yet'
+    return '%d, p50 < %s, p99 < %s, avg %s' % (
+        histogram.count, format_seconds(histogram.quantile(0.5)),
+        format_seconds(histogram.quantile(0.99)), format_seconds(histogram.sum / histogram.count))
+
+
+def format_seconds(seconds):
+    if seconds == float('inf'):
+        return 'inf'
+    return '%.2fms' % (seconds * 1000)
+
+
+def serve(hall, address):
+    """
+    Serve the metrics of hall at http://address/metrics, from a thread.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = hall.metrics.prometheus(hall).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass # scraped every few seconds, do not fill the console
+
+    server = ThreadingHTTPServer(address, MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='pychat-metrics', daemon=True).start()
+    log.info('Metrics at http://%s:%d/metrics', *server.server_address[:2])
+    return server
@@ -1,41 +1,767 @@
-# implementing 3-tier structure: Hall --> Room --> Clients; 
+# implementing 3-tier structure: Hall --> Room --> Clients;
 # 14-Jun-2013
 
-import select, socket, sys, pdb
+import argparse, asyncio, json, logging, multiprocessing, os, select, signal, socket, struct, \
+    sys, threading, time, zlib, pdb
 from pychat_util import Hall, Room, Player
 import pychat_util
+import pychat_metrics
+import pychat_logging
+
+log = logging.getLogger('pychat.server')
 
 READ_BUFFER = 4096
+LOG_SAMPLE = {'pychat.messages': 100} # records per second, see pychat_logging
+REAP_INTERVAL = 1.0 # seconds between looks for empty rooms to drop
+HANDOVER_TIMEOUT = 10 # seconds for the new process of a hot restart to take over
+HANDOVER_FDS = 250 # descriptors per message, Linux takes at most 253
+SNAPSHOT_HEADER = struct.Struct('!I') # length of the JSON snapshot
+METRICS_RETRIES = 50 # tries, 0.1 second apart, to get the metrics port after a take over
 
-host = sys.argv[1] if len(sys.argv) >= 2 else ''
-listen_sock = pychat_util.create_socket((host, pychat_util.PORT))
 
-hall = Hall()
-connection_list = []
-connection_list.append(listen_sock)
+def drop_player(hall, player):
+    hall.remove_player(player)
+    player.socket.close()
 
-while True:
-    # Player.fileno()
-    read_players, write_players, error_sockets = select.select(connection_list, [], [])
-    for player in read_players:
-        if player is listen_sock: # new connection, player is a socket
-            new_socket, add = player.accept()
-            new_player = Player(new_socket)
-            connection_list.append(new_player)
-            hall.welcome_new(new_player)
 
-        else: # new message
-            try:
-                msg = player.socket.recv(READ_BUFFER)
-                if msg:
-                    msg = msg.decode().lower()
-                    hall.handle_msg(player, msg)
-                else:
-                    player.socket.close()
+def handle_data(hall, player, data):
+    """
+    Feed received bytes to the player's frame decoder and handle every
+    complete message. Returns False if the connection must be dropped.
+    """
+    if player.decompressor is not None:
+        try:
+            data = pychat_util.inflate(player.decompressor, data)
+        except (zlib.error, pychat_util.FrameError) as e:
+            log.warning("Bad compressed data from %s: %s", player.name, e)
+            return False
+    if player.mux is not None:
+        return handle_mux_data(hall, player, data)
+    try:
+        msgs = player.decoder.feed(data)
+    except pychat_util.FrameError as e:
+        log.warning("Bad frame from %s: %s", player.name, e)
+        return False
+    handle_msgs(hall, player, msgs)
+    return True
+
+
+def handle_mux_data(hall, link, data):
+    """
+    Dispatch the data received on a multiplexed connection to the players
+    of its channels. An empty chunk opens a new channel, or closes a known one.
+    """
+    try:
+        chunks = link.decoder.feed(data)
+    except pychat_util.FrameError as e:
+        log.warning("Bad frame from %s: %s", link.name, e)
+        return False
+    for channel, payload in chunks:
+        player = link.mux.get(channel)
+        if player is None:
+            if len(link.mux) >= hall.max_channels:
+                if not payload: # refuse to open it, and ignore what comes for it
+                    log.warning("Too many channels from %s", link.name)
+                    link.send(pychat_util.mux_chunk(channel))
+                continue
+            player = link.mux[channel] = hall.new_channel_player(link, channel)
+            hall.welcome_new(player)
+            if not payload:
+                continue
+        if not payload: # closed by the other side
+            del link.mux[channel]
+            hall.remove_player(player)
+        elif not handle_data(hall, player, payload):
+            del link.mux[channel]
+            hall.remove_player(player)
+            player.close()
+    return True
+
+
+def handle_msgs(hall, player, msgs):
+    for i, msg in enumerate(msgs):
+        try:
+            hall.handle_msg(player, msg.lower())
+        except Exception:
+            log.exception("Error handling message from %s", player.name)
+        if player.moving is not None:
+            # the rest is for the worker that takes the player over
+            player.unhandled = msgs[i + 1:]
+            return
+
+
+def serve_select(listen_sock, hall, control_sock=None):
+    connection_list = []
+    connection_list.append(listen_sock)
+    if control_sock is not None:
+        connection_list.append(control_sock)
+    # players taken over from the previous process, with their pending output
+    connection_list += [p for p in hall.players.values() if p.socket is not None]
+    write_waiting = set(p for p in hall.pending if p.socket is not None)
+
+    while True:
+        # Player.fileno(); wake up now and then while rooms wait to be reaped
+        timeout = REAP_INTERVAL if hall.empty_rooms else None
+        read_players, write_players, error_sockets = \
+            select.select(connection_list, list(write_waiting), [], timeout)
+        started = time.perf_counter()
+        hall.reap()
+        for player in read_players:
+            if player is listen_sock: # new connection, player is a socket
+                new_socket, add = player.accept()
+                new_player = hall.new_player(new_socket)
+                connection_list.append(new_player)
+                hall.welcome_new(new_player)
+
+            elif player is control_sock: # hot restart
+                if hand_over(hall, listen_sock, control_sock):
+                    return
+
+            else: # new message
+                try:
+                    msg = player.socket.recv(READ_BUFFER)
+                except OSError:
+                    msg = b''
+                if hall.metrics is not None:
+                    hall.metrics.bytes_in += len(msg)
+                if not (msg and handle_data(hall, player, msg)) \
+                        and player in connection_list:
+                    drop_player(hall, player)
                     connection_list.remove(player)
-            except Exception:
-                pass
+                    write_waiting.discard(player)
+
+        for player in write_players:
+            hall.pending.add(player)
+
+        while hall.pending: # dropping a player queues leave messages
+            blocked, evicted = hall.flush()
+            write_waiting.update(blocked)
+            for player in evicted:
+                log.info("Disconnecting client: %s", player.name)
+                write_waiting.discard(player)
+                if player in connection_list:
+                    connection_list.remove(player)
+                    drop_player(hall, player)
+        write_waiting = set(p for p in write_waiting if p.outbox and not p.evicted)
+
+        for sock in error_sockets: # close error sockets
+            sock.close()
+            connection_list.remove(sock)
+
+        if hall.metrics is not None:
+            hall.metrics.loop.observe(time.perf_counter() - started)
+
+
+def raise_fd_limit():
+    # select() stops at FD_SETSIZE, epoll does not: let the process use
+    # as many descriptors as the hard limit allows
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            pass
+
+
+class AsyncServer:
+    """
+    asyncio engine: the event loop (epoll on Linux) calls back only the
+    connections that are ready, instead of scanning a list on each wakeup.
+    """
+
+    def __init__(self, listen_sock, hall, control_sock=None):
+        self.listen_sock = listen_sock
+        self.hall = hall
+        self.control_sock = control_sock
+        self.loop = asyncio.new_event_loop()
+        self.flush_scheduled = False
+        self.busy_since = None # start of the work of this loop iteration
+
+    def mark_busy(self):
+        # the flush ends the work of the iteration, see schedule_flush
+        if self.busy_since is None and self.hall.metrics is not None:
+            self.busy_since = time.perf_counter()
+
+    def on_accept(self):
+        self.mark_busy()
+        # drain the accept queue, several clients may be waiting
+        while True:
+            try:
+                new_socket, add = self.listen_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e: # e.g. EMFILE, retry on next wakeup
+                log.warning("accept failed: %s", e)
+                break
+            new_player = self.hall.new_player(new_socket)
+            self.loop.add_reader(new_player.fileno(), self.on_readable, new_player)
+            self.hall.welcome_new(new_player)
+        self.schedule_flush()
+
+    def on_readable(self, player):
+        self.mark_busy()
+        try:
+            msg = player.socket.recv(READ_BUFFER)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            msg = b''
+        if self.hall.metrics is not None:
+            self.hall.metrics.bytes_in += len(msg)
+        if not (msg and handle_data(self.hall, player, msg)):
+            self.disconnect(player)
+        self.schedule_flush()
+
+    def on_writable(self, player):
+        self.hall.pending.add(player)
+        self.flush()
+        if not player.outbox and player.socket.fileno() >= 0:
+            self.loop.remove_writer(player.fileno())
+
+    def disconnect(self, player):
+        if player.socket.fileno() < 0: # already closed
+            return
+        self.loop.remove_reader(player.fileno())
+        self.loop.remove_writer(player.fileno())
+        drop_player(self.hall, player)
+
+    def schedule_flush(self):
+        # flush once per loop iteration, after every ready reader has run
+        if (self.hall.pending or self.busy_since is not None) and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        while self.hall.pending:
+            blocked, evicted = self.hall.flush()
+            for player in blocked:
+                self.loop.add_writer(player.fileno(), self.on_writable, player)
+            for player in evicted:
+                log.info("Disconnecting client: %s", player.name)
+                self.disconnect(player)
+        if self.busy_since is not None:
+            self.hall.metrics.loop.observe(time.perf_counter() - self.busy_since)
+            self.busy_since = None
+
+    def reap(self):
+        self.hall.reap()
+        self.loop.call_later(REAP_INTERVAL, self.reap)
+
+    def on_control(self):
+        if hand_over(self.hall, self.listen_sock, self.control_sock):
+            self.loop.stop()
+
+    def run(self):
+        self.loop.add_reader(self.listen_sock.fileno(), self.on_accept)
+        if self.control_sock is not None:
+            self.loop.add_reader(self.control_sock.fileno(), self.on_control)
+        # players taken over from the previous process
+        for player in self.hall.players.values():
+            if player.socket is not None:
+                self.loop.add_reader(player.fileno(), self.on_readable, player)
+        self.schedule_flush()
+        self.loop.call_later(REAP_INTERVAL, self.reap)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.close()
+
+
+def serve_asyncio(listen_sock, hall, control_sock=None):
+    raise_fd_limit()
+    AsyncServer(listen_sock, hall, control_sock).run()
+
+
+def create_control_socket(path):
+    # a leftover socket file from a previous run would make bind fail
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    control_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    control_sock.bind(path)
+    control_sock.listen(1)
+    control_sock.setblocking(0)
+    return control_sock
+
+
+def hand_over(hall, listen_sock, control_sock):
+    """
+    Hot restart, old side: a new server process connected to the control
+    socket. Send it a snapshot of the hall, then the listening socket and
+    the sockets of the players (SCM_RIGHTS), and wait for it to take over.
+    Nothing is served meanwhile: clients only see a short pause.
+    @return: True if the new process took over, False to go on serving
+    """
+    try:
+        conn, addr = control_sock.accept()
+    except (BlockingIOError, InterruptedError):
+        return False
+    started = time.perf_counter()
+    paused_at = time.time()
+    conn.settimeout(HANDOVER_TIMEOUT)
+    sockets = []
+    try:
+        hall.flush() # what cannot be written now goes along in the snapshot
+        if hall.message_log is not None:
+            hall.message_log.sync() # the new process reopens the room logs
+        snapshot, sockets = hall.snapshot()
+        snapshot['fds'] = len(sockets) + 1
+        snapshot['paused_at'] = paused_at
+        data = json.dumps(snapshot).encode()
+        conn.sendall(SNAPSHOT_HEADER.pack(len(data)) + data)
+        fds = [listen_sock.fileno()] + [sock.fileno() for sock in sockets]
+        for i in range(0, len(fds), HANDOVER_FDS):
+            socket.send_fds(conn, [b'F'], fds[i:i + HANDOVER_FDS])
+        taken = conn.recv(1) == b'K'
+    except OSError as e:
+        log.warning("Hot restart failed: %s", e)
+        taken = False
+    finally:
+        conn.close()
+    if not taken:
+        log.warning("The new server did not take over, serving on")
+        return False
+    log.info("Handed over %d connection(s) in %.1f ms",
+             len(sockets), (time.perf_counter() - started) * 1000)
+    return True
+
+
+def take_over(path):
+    """
+    Hot restart, new side: connect to the control socket of the running
+    server and receive its snapshot and sockets (see hand_over).
+    @return: (connection to the old process, snapshot, file descriptors),
+             the listening socket first
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(HANDOVER_TIMEOUT)
+    conn.connect(path)
+    length, = SNAPSHOT_HEADER.unpack(recv_exactly(conn, SNAPSHOT_HEADER.size))
+    snapshot = json.loads(recv_exactly(conn, length).decode())
+    fds = []
+    while len(fds) < snapshot['fds']:
+        msg, new_fds, flags, addr = socket.recv_fds(conn, 1, HANDOVER_FDS)
+        if not msg:
+            raise ConnectionError('the old server closed the connection')
+        fds += new_fds
+    return conn, snapshot, fds
+
+
+def recv_exactly(sock, size):
+    # never more: the bytes that follow carry the descriptors
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('the old server closed the connection')
+        data += chunk
+    return bytes(data)
+
+
+# a handed over player (state + queued bytes) must fit in one datagram: at
+# most half the send buffer of the socket pair, which the kernel may cap lower
+MAX_HANDOFF = 1024 * 1024
+HANDOFF_HEADER = struct.Struct('!III') # lengths of the JSON state, inbuf and outbuf
+PUBLISH_INTERVAL = 1.0 # seconds between room list updates to the other workers
+
+
+def shard_of(room_name, workers):
+    # crc32 rather than hash(): it must be the same in every process
+    return zlib.crc32(room_name.encode()) % workers
+
+
+def unpack_handoff(data):
+    """
+    @return: (state, inbuf, outbuf) of a player handed over by another worker
+    @raise ValueError: If the datagram is not a complete handoff
+    """
+    try:
+        state_size, inbuf_size, outbuf_size = HANDOFF_HEADER.unpack_from(data)
+    except struct.error as e:
+        raise ValueError(e)
+    start = HANDOFF_HEADER.size
+    end = start + state_size
+    if end + inbuf_size + outbuf_size != len(data):
+        raise ValueError('truncated handoff of %d bytes' % len(data))
+    state = json.loads(data[start:end].decode())
+    if not isinstance(state, dict) or not {'name', 'named', 'join', 'msgs'} <= state.keys():
+        raise ValueError('incomplete state')
+    return state, data[end:end + inbuf_size], data[end + inbuf_size:]
+
+
+class ShardRouter:
+    """
+    Tells the Hall of a worker which rooms it owns, and keeps the room
+    list published by the other workers for <list>.
+    """
+
+    def __init__(self, index, workers):
+        self.index = index
+        self.workers = workers
+        self.remote = {} # {worker_index: {room_name: player_count}}
+
+    def is_local(self, room_name):
+        return shard_of(room_name, self.workers) == self.index
+
+    def remote_rooms(self):
+        rooms = {}
+        for counts in self.remote.values():
+            rooms.update(counts)
+        return rooms
+
+
+class ShardedServer(AsyncServer):
+    """
+    One worker process of a sharded server. All the workers accept on the
+    same port (SO_REUSEPORT), and each owns the rooms whose name hashes to
+    its index. A player joining a room owned by another worker is handed
+    over to it: its socket is passed over a Unix socket (SCM_RIGHTS)
+    together with its name and buffered data, so the client sees nothing.
+    """
+
+    def __init__(self, listen_sock, hall, index, channels):
+        AsyncServer.__init__(self, listen_sock, hall)
+        self.index = index
+        self.inbox = channels[index][0]
+        self.peers = [channel[1] for channel in channels]
+        self.handoff_limit = min(MAX_HANDOFF, min(
+            peer.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF) for peer in self.peers) // 2)
+        self.published = None
+        hall.router = ShardRouter(index, len(channels))
+
+    def on_readable(self, player):
+        AsyncServer.on_readable(self, player)
+        if player.moving is not None and player.socket.fileno() >= 0:
+            self.hand_off(player)
+
+    def hand_off(self, player):
+        join, player.moving = player.moving, None
+        room_name = join.split(' ', 1)[0]
+        fd = player.fileno()
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        self.hall.pending.discard(player)
+        player.flush()
+        state = self.hall.player_state(player)
+        self.hall.remove_player(player)
+        # the buffers go as they are after the JSON, which would escape them
+        inbuf = state.pop('inbuf').encode('latin-1')
+        del state['outbuf']
+        state['join'] = join
+        state['msgs'] = player.unhandled
+        header = json.dumps(state).encode()
+        # what does not fit is dropped, oldest messages first, as for a slow client
+        player.outbox.shrink(self.handoff_limit - HANDOFF_HEADER.size - len(header) - len(inbuf))
+        outbuf = player.outbox.take()
+        data = HANDOFF_HEADER.pack(len(header), len(inbuf), len(outbuf)) + header + inbuf + outbuf
+        peer = self.peers[shard_of(room_name, len(self.peers))]
+        try:
+            socket.send_fds(peer, [data], [fd])
+        except OSError as e:
+            log.warning("Could not hand over %s (%d bytes): %s", player.name, len(data), e)
+        player.socket.close()
+
+    def on_handoff(self):
+        self.mark_busy()
+        while True:
+            try:
+                data, fds, flags, addr = socket.recv_fds(self.inbox, MAX_HANDOFF, 1)
+            except (BlockingIOError, InterruptedError):
+                break
+            try:
+                if not fds: # room list published by another worker
+                    rooms = json.loads(data.decode())
+                    self.hall.router.remote[rooms['worker']] = rooms['rooms']
+                    continue
+                state, inbuf, outbuf = unpack_handoff(data)
+            except (ValueError, KeyError, TypeError) as e:
+                log.warning("Bad message from another worker: %s", e)
+                for fd in fds:
+                    os.close(fd)
+                continue
+            player = self.hall.new_player(socket.socket(fileno=fds[0]))
+            if state['named'] and not self.hall.set_name(player, state['name']):
+                # names are unique per worker only, ask for another one
+                self.hall.set_player_name(player, state['name'])
+            if outbuf:
+                player.send(outbuf)
+            self.loop.add_reader(player.fileno(), self.on_readable, player)
+            handle_msgs(self.hall, player, ['<join> ' + state['join']] + state['msgs'])
+            if player.moving is None and not handle_data(self.hall, player, inbuf):
+                self.disconnect(player)
+            elif player.moving is not None:
+                player.decoder.feed(inbuf)
+                self.hand_off(player)
+        self.schedule_flush()
+
+    def publish_rooms(self):
+        rooms = {name: len(room.players) for name, room in self.hall.rooms.items()}
+        if rooms != self.published:
+            self.published = rooms
+            msg = json.dumps({'worker': self.index, 'rooms': rooms}).encode()
+            for i, peer in enumerate(self.peers):
+                if i != self.index:
+                    try:
+                        peer.send(msg)
+                    except OSError:
+                        pass
+        self.loop.call_later(PUBLISH_INTERVAL, self.publish_rooms)
+
+    def run(self):
+        self.inbox.setblocking(False)
+        self.loop.add_reader(self.inbox.fileno(), self.on_handoff)
+        self.loop.call_soon(self.publish_rooms)
+        AsyncServer.run(self)
+
+
+def run_worker(args, index, channels):
+    log_listener = pychat_logging.setup_from_args(args) # threads do not survive the fork
+    raise_fd_limit()
+    listen_sock = pychat_util.create_socket((args.host, pychat_util.PORT),
+                                            args.backlog, reuse_port=True)
+    hall = make_hall(args, index)
+    try:
+        ShardedServer(listen_sock, hall, index, channels).run()
+    except KeyboardInterrupt:
+        log.info('Worker %d output: %s', index, hall.io_stats)
+    close_hall(hall)
+    log_listener.stop()
+
+
+def serve_sharded(args):
+    """
+    Start args.workers processes sharing the port, connected to each
+    other by one SOCK_SEQPACKET socket pair per worker (its inbox).
+    """
+    channels = [socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+                for i in range(args.workers)]
+    for inbox, peer in channels: # room for a player with a full outbox
+        peer.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MAX_HANDOFF * 2)
+    context = multiprocessing.get_context('fork')
+    workers = [context.Process(target=run_worker, args=(args, i, channels))
+               for i in range(args.workers)]
+    for worker in workers:
+        worker.start()
+    # set after the fork: a SIGTERM (kill, service stop) only reaches this process
+    signal.signal(signal.SIGTERM, stop_sharded)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers: # they normally got the SIGINT too
+            worker.join(1)
+            if worker.is_alive():
+                worker.terminate()
+    except SystemExit:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        raise
+
+
+def stop_sharded(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+ENGINES = {'select': serve_select, 'asyncio': serve_asyncio}
+
+
+def make_hall(args, index=0):
+    hall = Hall(args.max_outbound, args.slow_policy, pychat_util.CODECS[args.framing],
+                args.history, args.history_bytes, args.mentions, not args.no_mention_echo,
+                args.flood_rate, args.flood_burst, args.room_rate, args.room_burst,
+                args.flood_policy, args.room_grace, args.max_channels)
+    hall.admin_secret = args.admin_secret
+    if not args.no_metrics:
+        hall.metrics = pychat_metrics.Metrics()
+        if args.metrics_port:
+            # one port per worker
+            start_metrics(hall, (args.metrics_host, args.metrics_port + index),
+                          args.take_over)
+    if args.log_dir:
+        import pychat_log
+        hall.message_log = pychat_log.MessageLog(args.log_dir, args.log_segment_bytes,
+                                                 args.log_fsync)
+    return hall
+
+
+def start_metrics(hall, address, wait=False):
+    """
+    Serve the metrics. With wait, the port may still be held by the process
+    being taken over, until it exits: keep trying from a thread.
+    """
+    if not wait:
+        pychat_metrics.serve(hall, address)
+        return
+    def retry():
+        for attempt in range(METRICS_RETRIES):
+            try:
+                pychat_metrics.serve(hall, address)
+                return
+            except OSError:
+                time.sleep(0.1)
+        log.warning("Could not serve the metrics on port %d", address[1])
+    threading.Thread(target=retry, daemon=True).start()
+
+
+def close_hall(hall):
+    if hall.message_log is not None:
+        hall.message_log.close()
+
+
+def take_over_from(args):
+    """
+    Take over the listening socket, clients and rooms of the server
+    listening on args.control.
+    @return: (listen_sock, hall)
+    """
+    try:
+        conn, snapshot, fds = take_over(args.control)
+    except (OSError, ValueError) as e:
+        log.error("Could not take over from %s: %s", args.control, e)
+        sys.exit(1)
+    if snapshot['framing'] != args.framing:
+        # the clients would not understand us: the old server serves on
+        log.error("The running server uses --framing %s", snapshot['framing'])
+        for fd in fds:
+            os.close(fd)
+        sys.exit(1)
+    listen_sock = socket.socket(fileno=fds[0])
+    listen_sock.setblocking(0)
+    sockets = [socket.socket(fileno=fd) for fd in fds[1:]]
+    for sock in sockets:
+        sock.setblocking(0)
+    hall = make_hall(args)
+    hall.restore(snapshot, sockets)
+    conn.sendall(b'K')
+    conn.close()
+    log.info("Took over %d player(s) in %d room(s), %.1f ms without serving",
+             len(hall.players), len(hall.rooms), (time.time() - snapshot['paused_at']) * 1000)
+    return listen_sock, hall
+
+
+def main():
+    parser = argparse.ArgumentParser(description='pychat server')
+    parser.add_argument('host', nargs='?', default='',
+                        help="address to listen on (default: all interfaces)")
+    parser.add_argument('--engine', choices=sorted(ENGINES), default='select',
+                        help="event loop: select (default) or asyncio (epoll)")
+    parser.add_argument('--backlog', type=int, default=None,
+                        help="listen backlog (default: %d for select, "
+                             "SOMAXCONN for asyncio)" % pychat_util.MAX_CLIENTS)
+    parser.add_argument('--max-outbound', type=int, default=pychat_util.MAX_OUTBOUND,
+                        help="bytes queued per client before the slow client "
+                             "policy applies (default: %(default)s)")
+    parser.add_argument('--slow-policy', choices=pychat_util.SLOW_POLICIES,
+                        default=pychat_util.DROP_OLDEST,
+                        help="drop the oldest queued messages, or disconnect "
+                             "the client (default: %(default)s)")
+    parser.add_argument('--framing', choices=sorted(pychat_util.CODECS), default='newline',
+                        help="message framing, clients must use the same "
+                             "(default: %(default)s)")
+    parser.add_argument('--history', type=int, default=pychat_util.HISTORY_SIZE,
+                        help="messages kept per room and replayed to players "
+                             "joining it, 0 to disable (default: %(default)s)")
+    parser.add_argument('--history-bytes', type=int, default=pychat_util.HISTORY_BYTES,
+                        help="memory limit of the history of each room "
+                             "(default: %(default)s)")
+    parser.add_argument('--room-grace', type=float, default=pychat_util.ROOM_GRACE,
+                        help="seconds an empty room is kept, with its history, "
+                             "-1 to keep them all (default: %(default)s)")
+    parser.add_argument('--log-dir',
+                        help="keep an append-only log of every room in this "
+                             "directory, replayed after a restart")
+    parser.add_argument('--log-segment-bytes', type=int, default=4 * 1024 * 1024,
+                        help="size of the log files of a room (default: %(default)s)")
+    parser.add_argument('--log-fsync', type=float, default=1.0,
+                        help="seconds between fsyncs of the log, 0 for every "
+                             "write, -1 for never (default: %(default)s)")
+    parser.add_argument('--mentions', choices=pychat_util.MENTION_MODES,
+                        default=pychat_util.MENTIONS_DIRECT,
+                        help="send a message starting with @name to that player "
+                             "only, or to the whole room (default: %(default)s)")
+    parser.add_argument('--no-mention-echo', action='store_true',
+                        help="do not send a direct mention back to its sender")
+    parser.add_argument('--flood-rate', type=float, default=pychat_util.FLOOD_RATE,
+                        help="messages per second allowed to each player, 0 for "
+                             "no limit (default: %(default)s)")
+    parser.add_argument('--flood-burst', type=int, default=pychat_util.FLOOD_BURST,
+                        help="messages a player may send at once (default: %(default)s)")
+    parser.add_argument('--room-rate', type=float, default=pychat_util.ROOM_RATE,
+                        help="messages per second said in each room, 0 for no "
+                             "limit (default: %(default)s)")
+    parser.add_argument('--room-burst', type=int, default=pychat_util.ROOM_BURST,
+                        help="messages said at once in a room (default: %(default)s)")
+    parser.add_argument('--flood-policy', choices=pychat_util.FLOOD_POLICIES,
+                        default=pychat_util.FLOOD_NOTIFY,
+                        help="drop the messages over the limits, or also tell the "
+                             "room how many were dropped (default: %(default)s)")
+    parser.add_argument('--max-channels', type=int, default=pychat_util.MAX_CHANNELS,
+                        help="clients one multiplexed connection may carry "
+                             "(default: %(default)s)")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="do not measure the server (<stats>, --metrics-port)")
+    parser.add_argument('--metrics-port', type=int,
+                        help="serve the metrics in the Prometheus format on this "
+                             "port (the next ones for the other workers)")
+    parser.add_argument('--metrics-host', default='127.0.0.1',
+                        help="address of the metrics endpoint (default: %(default)s)")
+    parser.add_argument('--admin-secret',
+                        help="lets remote clients use <stats> SECRET (case is ignored; "
+                             "clients on this machine need no secret)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="number of processes, rooms are spread over them "
+                             "(implies the asyncio engine, default: 1)")
+    parser.add_argument('--control', metavar='PATH',
+                        help="Unix socket on which a new server process can take over "
+                             "(hot restart), e.g. /tmp/pychat.sock")
+    parser.add_argument('--take-over', action='store_true',
+                        help="take over the clients of the server listening on the "
+                             "--control socket, then listen on it in its place")
+    pychat_logging.add_arguments(parser, LOG_SAMPLE)
+    args = parser.parse_args()
+    if args.take_over and not args.control:
+        parser.error('--take-over needs --control')
+    if args.control and args.workers > 1:
+        parser.error('--control is not supported with --workers')
+    log_listener = pychat_logging.setup_from_args(args)
+
+    if args.workers > 1:
+        args.engine = 'asyncio'
+    if args.backlog is None:
+        args.backlog = socket.SOMAXCONN if args.engine == 'asyncio' else pychat_util.MAX_CLIENTS
+
+    if args.workers > 1:
+        serve_sharded(args)
+        log.info('Goodbye !')
+        log_listener.stop()
+        return
+
+    if args.take_over:
+        listen_sock, hall = take_over_from(args)
+    else:
+        listen_sock = pychat_util.create_socket((args.host, pychat_util.PORT), args.backlog)
+        hall = make_hall(args)
+    control_sock = None
+    if args.control:
+        control_sock = create_control_socket(args.control)
+    try:
+        ENGINES[args.engine](listen_sock, hall, control_sock)
+        log.info('Output: %s', hall.io_stats)
+        log.info('Handed over, goodbye !')
+    except KeyboardInterrupt:
+        log.info('Output: %s', hall.io_stats)
+        log.info('Goodbye !')
+    close_hall(hall)
+    log_listener.stop()
+
 
-    for sock in error_sockets: # close error sockets
-        sock.close()
-        connection_list.remove(sock)
+if __name__ == '__main__':
+    main()
@@ -1,132 +1,1271 @@
 # implementing 3-tier structure: Hall --> Room --> Clients; 
 # 14-Jun-2013
 
-import socket, pdb
+import hmac, ipaddress, itertools, logging, re, socket, struct, time, zlib, pdb
+from collections import deque
 
 MAX_CLIENTS = 30
 PORT = 22222
 QUIT_STRING = '<$quit$>'
 
+# log categories, see pychat_logging: pass values as arguments, not formatted
+log = logging.getLogger('pychat')
+players_log = logging.getLogger('pychat.players')
+messages_log = logging.getLogger('pychat.messages')
 
-def create_socket(address):
+# what to do when a player does not read fast enough and its outbound
+# queue reaches MAX_OUTBOUND bytes
+MAX_OUTBOUND = 256 * 1024
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+SLOW_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+# messages kept per room, replayed to players joining late
+HISTORY_SIZE = 50
+HISTORY_BYTES = 16 * 1024
+MAX_REPLAY = 1000 # most messages sent by one <history n>
+
+# a message starting with @name is sent to that player only (and echoed to
+# the sender), unless mentions are broadcast to the whole room like before
+MENTION_RE = re.compile(r'@([a-zA-Z0-9_]+)')
+MENTIONS_DIRECT = 'direct'
+MENTIONS_BROADCAST = 'broadcast'
+MENTION_MODES = (MENTIONS_DIRECT, MENTIONS_BROADCAST)
+
+# an empty room is dropped after this many seconds, with its history (its
+# log stays on disk); -1 to keep every room
+ROOM_GRACE = 600
+
+# flood control: messages per second, and bursts, said by each player
+# (commands are not limited) and in each room (0 for no limit). Past the
+# limit, messages are dropped, or dropped and counted in one notice sent when
+# the sender is allowed to speak again. A Scratch bridge may send the 100
+# messages it kept while reconnecting at once (OUTGOING_QUEUE)
+FLOOD_RATE = 5
+FLOOD_BURST = 100
+ROOM_RATE = 50
+ROOM_BURST = 100
+FLOOD_DROP = 'drop'
+FLOOD_NOTIFY = 'notify'
+FLOOD_POLICIES = (FLOOD_DROP, FLOOD_NOTIFY)
+
+# a player may ask for the messages of its room containing some keywords
+# only (<subscribe> word ^prefix), to a limit
+MAX_FILTERS = 50
+MAX_FILTER_LENGTH = 100
+
+# a peer sending a frame bigger than this is broken (or hostile)
+MAX_FRAME = 64 * 1024
+
+# max buffers in one sendmsg() call (IOV_MAX is 1024 on Linux)
+MAX_IOV = 1024
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg') # not on Windows
+
+
+class FrameError(ValueError):
+    pass
+
+
+class LineDecoder:
+    """
+    Incremental decoder for newline terminated frames.
+    Bytes are kept until a whole line has arrived, so a chunk may hold
+    several messages, or end in the middle of one (or in the middle of a
+    multi-byte UTF-8 character).
+    """
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.scanned = 0 # bytes of buffer known not to contain a newline
+        self.max_frame = max_frame
+
+    def feed(self, data):
+        """
+        Add received bytes, and return the list of complete messages.
+        """
+        self.buffer += data
+        msgs = []
+        start = 0
+        while True:
+            end = self.buffer.find(b'\n', max(start, self.scanned))
+            if end < 0:
+                break
+            msgs.append(self.buffer[start:end].decode('utf-8', 'replace').rstrip('\r'))
+            start = end + 1
+        if start:
+            del self.buffer[:start]
+        self.scanned = len(self.buffer)
+        if self.scanned > self.max_frame:
+            raise FrameError('line longer than {} bytes'.format(self.max_frame))
+        return msgs
+
+
+class LengthPrefixDecoder:
+    """
+    Incremental decoder for frames made of a 4-byte big-endian length
+    followed by the UTF-8 encoded message.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+
+    def feed(self, data):
+        self.buffer += data
+        msgs = []
+        start = 0
+        while len(self.buffer) - start >= 4:
+            length, = struct.unpack_from('!I', self.buffer, start)
+            if length > self.max_frame:
+                raise FrameError('frame of {} bytes is too big'.format(length))
+            if len(self.buffer) - start - 4 < length:
+                break
+            start += 4
+            msgs.append(self.buffer[start:start + length].decode('utf-8', 'replace'))
+            start += length
+        if start:
+            del self.buffer[:start]
+        return msgs
+
+
+class LineCodec:
+    name = 'newline'
+
+    def encode(self, msg):
+        return msg.encode() + b'\n'
+
+    def decoder(self):
+        return LineDecoder()
+
+
+class LengthPrefixCodec:
+    name = 'length'
+
+    def encode(self, msg):
+        data = msg.encode()
+        return struct.pack('!I', len(data)) + data
+
+    def decoder(self):
+        return LengthPrefixDecoder()
+
+
+CODECS = {codec.name: codec for codec in (LineCodec(), LengthPrefixCodec())}
+DEFAULT_CODEC = CODECS['newline']
+
+# After a client sends <mux> and the server answers MUX_ACK, the connection
+# carries the streams of many players (e.g. the Scratch sessions of a shared
+# bridge). Each chunk is then a header (channel id, length) followed by
+# length bytes of that channel's stream. A chunk of length 0 opens a new
+# channel, or closes a known one.
+MUX_COMMAND = '<mux>'
+MUX_ACK = '<mux> ok'
+MUX_HEADER = struct.Struct('!II')
+# channels of one connection; together they may say as much as that many
+# players, however often they are closed and opened again
+MAX_CHANNELS = 200
+
+
+def mux_chunk(channel, data=b''):
+    return MUX_HEADER.pack(channel, len(data)) + bytes(data)
+
+
+class MuxDecoder:
+    """
+    Incremental decoder for a multiplexed connection.
+    """
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+
+    def feed(self, data):
+        """
+        Add received bytes, and return the list of complete (channel, data)
+        chunks, data being empty when the channel is closed.
+        """
+        self.buffer += data
+        chunks = []
+        start = 0
+        while len(self.buffer) - start >= MUX_HEADER.size:
+            channel, length = MUX_HEADER.unpack_from(self.buffer, start)
+            if length > self.max_frame:
+                raise FrameError('chunk of {} bytes is too big'.format(length))
+            end = start + MUX_HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            chunks.append((channel, bytes(self.buffer[start + MUX_HEADER.size:end])))
+            start = end
+        if start:
+            del self.buffer[:start]
+        return chunks
+
+
+# After a client sends <compress> and the server answers COMPRESS_ACK, both
+# directions of the connection are zlib streams, flushed (Z_SYNC_FLUSH)
+# after each batch of frames. Both sides preset the same dictionary of
+# common protocol strings: it must never change, or old peers break.
+COMPRESS_COMMAND = '<compress>'
+COMPRESS_ACK = '<compress> ok'
+COMPRESS_LEVEL = 6
+COMPRESS_DICT = (b'Welcome to pychat.\nPlease tell us your name:\n'
+                 b'Instructions:\n[<list>] to list all rooms\n'
+                 b'[<join> room_name] to join/create/switch to a room\n'
+                 b'[<manual>] to show instructions\n[<quit>] to quit\n'
+                 b'Otherwise start typing and enjoy!\n'
+                 b'You are currently not in any room! \nListing current rooms...\n'
+                 b' player(s)\n has left the room\n<join> <list> name: \n welcomes: ')
+MAX_INFLATE = 1024 * 1024 # most bytes inflated from one read
+
+
+def new_compressor():
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS,
+                            zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, COMPRESS_DICT)
+
+
+def new_decompressor():
+    return zlib.decompressobj(zlib.MAX_WBITS, COMPRESS_DICT)
+
+
+def compress_frames(compressor, frames):
+    """
+    Compress frames, and flush so that the peer can decode them at once.
+    """
+    data = b''.join(compressor.compress(frame) for frame in frames)
+    return data + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def inflate(decompressor, data):
+    data = decompressor.decompress(data, MAX_INFLATE)
+    if decompressor.unconsumed_tail:
+        raise FrameError('compressed data inflates too much')
+    return data
+
+
+def read_answer(sock, codec, ack):
+    """
+    Client side of a negotiation (COMPRESS_COMMAND): read the answer of the
+    server from a blocking socket, nothing else being expected before it.
+    An older server answers something else (it takes the command for text).
+    @return: True and the bytes received after the ack (in the new mode),
+             or False and the bytes received (in the old mode)
+    """
+    frame = codec.encode(ack)
+    buffer = b''
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            return False, buffer
+        buffer += data
+        end = buffer.find(frame)
+        if end >= 0:
+            return True, buffer[end + len(frame):]
+        if codec.decoder().feed(buffer): # a whole message, but not the ack
+            return False, buffer
+
+
+class CompressedSocket:
+    """
+    Client side of a compressed connection, used like the socket it wraps.
+    """
+
+    def __init__(self, sock, received=b''):
+        """
+        @param received: Bytes already received after COMPRESS_ACK
+        """
+        self.socket = sock
+        self.compressor = new_compressor()
+        self.decompressor = new_decompressor()
+        self.received = received
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def sendall(self, data):
+        self.socket.sendall(compress_frames(self.compressor, [data]))
+
+    def recv(self, bufsize):
+        """
+        Return inflated bytes, or b'' when the connection is closed.
+        """
+        while True:
+            data, self.received = self.received or self.socket.recv(bufsize), b''
+            if not data:
+                return b''
+            data = inflate(self.decompressor, data)
+            if data: # else only part of a compressed block arrived
+                return data
+
+    def settimeout(self, timeout):
+        self.socket.settimeout(timeout)
+
+    def shutdown(self, how):
+        self.socket.shutdown(how)
+
+    def close(self):
+        self.socket.close()
+
+
+def create_socket(address, backlog=MAX_CLIENTS, reuse_port=False):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port: # several processes accept on the same port
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     s.setblocking(0)
     s.bind(address)
-    s.listen(MAX_CLIENTS)
-    print("Now listening at ", address)
+    s.listen(backlog)
+    log.info("Now listening at %s", address)
     return s
 
+INSTRUCTIONS = 'Instructions:\n'\
+    + '[<list>] to list all rooms\n'\
+    + '[<join> room_name] to join/create/switch to a room ([<join> room_name 0] without its history)\n' \
+    + '[<history> n] to show the last n messages of the room\n' \
+    + '[<subscribe> word ^start] to only get the messages with a word, or starting with one\n' \
+    + '[<unsubscribe>] to get every message again\n' \
+    + '[<manual>] to show instructions\n' \
+    + '[<quit>] to quit\n' \
+    + 'Otherwise start typing and enjoy!'
+NAME_TAKEN_STRING = ' is already taken.' # answer to a name: used by another player
+
+
 class Hall:
-    def __init__(self):
+    def __init__(self, max_outbound=MAX_OUTBOUND, slow_policy=DROP_OLDEST,
+                 codec=DEFAULT_CODEC, history_size=HISTORY_SIZE,
+                 history_bytes=HISTORY_BYTES, mentions=MENTIONS_DIRECT,
+                 mention_echo=True, flood_rate=FLOOD_RATE, flood_burst=FLOOD_BURST,
+                 room_rate=ROOM_RATE, room_burst=ROOM_BURST, flood_policy=FLOOD_NOTIFY,
+                 room_grace=ROOM_GRACE, max_channels=MAX_CHANNELS):
         self.rooms = {} # {room_name: Room}
-        self.room_player_map = {} # {playerName: roomName}
+        self.empty_rooms = {} # {room_name: time it became empty}, oldest first
+        self.room_player_map = {} # {player_id: roomName}
+        self.players = {} # {player_id: Player}, every connected player
+        self.names = {} # {playerName: Player}, names are unique
+        self.next_id = itertools.count(1)
+        self.pending = set() # players with queued output
+        self.io_stats = IOStats()
+        self.router = None # set when rooms are sharded across processes
+        self.message_log = None # set to log rooms on disk (see pychat_log)
+        self.metrics = None # set to measure the server (see pychat_metrics)
+        # with <stats> secret, remote clients may use it too (names are not credentials)
+        self.admin_secret = None
+        self.max_outbound = max_outbound
+        self.slow_policy = slow_policy
+        self.codec = codec
+        self.history_size = history_size
+        self.history_bytes = history_bytes
+        self.mentions = mentions
+        self.mention_echo = mention_echo
+        self.flood_rate = flood_rate
+        self.flood_burst = flood_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.flood_policy = flood_policy
+        self.room_grace = room_grace
+        self.max_channels = max_channels
+
+    def new_player(self, socket):
+        outbox = Outbox(self.max_outbound, self.slow_policy)
+        player = Player(socket, outbox=outbox, pending=self.pending, codec=self.codec)
+        player.id = next(self.next_id)
+        player.bucket = self.new_bucket(self.flood_rate, self.flood_burst)
+        self.players[player.id] = player
+        if self.metrics is not None:
+            self.metrics.connections += 1
+        return player
+
+    def new_channel_player(self, link, channel):
+        player = ChannelPlayer(link, channel, self.codec)
+        player.id = next(self.next_id)
+        player.bucket = self.new_bucket(self.flood_rate, self.flood_burst)
+        self.players[player.id] = player
+        if self.metrics is not None:
+            self.metrics.connections += 1
+        return player
+
+    def new_bucket(self, rate, burst):
+        return TokenBucket(rate, burst) if rate > 0 else None
 
     def welcome_new(self, new_player):
-        new_player.socket.sendall(b'Welcome to pychat.\nPlease tell us your name:\n')
+        new_player.send_msg('Welcome to pychat.\nPlease tell us your name:')
+
+    def flush(self):
+        """
+        Write out what was queued for each player since the last call.
+        Returns the players that still have data waiting for the socket
+        to become writable, and the players that must be disconnected.
+        """
+        blocked, evicted = [], []
+        while self.pending:
+            player = self.pending.pop()
+            if not player.evicted:
+                player.flush(self.io_stats)
+            if player.evicted:
+                evicted.append(player)
+            elif player.outbox:
+                blocked.append(player)
+        return blocked, evicted
+
+    def set_name(self, player, name):
+        """
+        Give a name to a player, unless another player already uses it.
+        @return: True if the player got the name
+        """
+        owner = self.names.get(name)
+        if owner is not None and owner is not player:
+            return False
+        if self.names.get(player.name) is player:
+            del self.names[player.name]
+        player.name = name
+        self.names[name] = player
+        return True
 
     def list_rooms(self, player):
         
-        if len(self.rooms) == 0:
+        rooms = {name: len(room.players) for name, room in self.rooms.items()}
+        if self.router is not None:
+            rooms.update(self.router.remote_rooms())
+        if len(rooms) == 0:
             msg = 'Oops, no active rooms currently. Create your own!\n' \
-                + 'Use [<join> room_name] to create a room.\n'
-            player.socket.sendall(msg.encode())
+                + 'Use [<join> room_name] to create a room.'
+            player.send_msg(msg)
         else:
-            msg = 'Listing current rooms...\n'
-            for room in self.rooms:
-                msg += room + ": " + str(len(self.rooms[room].players)) + " player(s)\n"
-            player.socket.sendall(msg.encode())
-    
+            msg = 'Listing current rooms...'
+            for room in rooms:
+                msg += '\n' + room + ": " + str(rooms[room]) + " player(s)"
+            player.send_msg(msg)
+
     def handle_msg(self, player, msg):
-        
-        instructions = b'Instructions:\n'\
-            + b'[<list>] to list all rooms\n'\
-            + b'[<join> room_name] to join/create/switch to a room\n' \
-            + b'[<manual>] to show instructions\n' \
-            + b'[<quit>] to quit\n' \
-            + b'Otherwise start typing and enjoy!' \
-            + b'\n'
-
-        print(player.name + " says: " + msg)
-        if "name:" in msg:
-            name = msg.split()[1]
-            player.name = name
-            print("New connection from:", player.name)
-            player.socket.sendall(instructions)
-
-        elif "<join>" in msg:
-            same_room = False
-            if len(msg.split()) >= 2: # error check
-                room_name = msg.split()[1]
-                if player.name in self.room_player_map: # switching?
-                    if self.room_player_map[player.name] == room_name:
-                        player.socket.sendall(b'You are already in room: ' + room_name.encode())
-                        same_room = True
-                    else: # switch
-                        old_room = self.room_player_map[player.name]
-                        self.rooms[old_room].remove_player(player)
-                if not same_room:
-                    if not room_name in self.rooms: # new room:
-                        new_room = Room(room_name)
-                        self.rooms[room_name] = new_room
-                    self.rooms[room_name].players.append(player)
-                    self.rooms[room_name].welcome_new(player)
-                    self.room_player_map[player.name] = room_name
-            else:
-                player.socket.sendall(instructions)
+        """
+        Handle one message from a player: the first word selects the
+        command in command_dict, anything else is said in the player's room.
+        """
+        if player.id not in self.players: # after <quit>, e.g. a name: would never be freed
+            return
+        messages_log.info("%s says: %s", player.name, msg)
+        if self.metrics is not None:
+            start = time.perf_counter()
+        word, _, arg = msg.partition(' ')
+        method = self.command_dict.get(word)
+        if method is None:
+            word = 'say'
+            self.say(player, msg)
+        else:
+            method(self, player, arg.strip())
+        if self.metrics is not None:
+            self.metrics.command(word, time.perf_counter() - start)
 
-        elif "<list>" in msg:
-            self.list_rooms(player) 
+    def set_player_name(self, player, arg):
+        name = arg.split(' ', 1)[0]
+        if not name:
+            player.send_msg('Please tell us your name:')
+        elif not self.set_name(player, name):
+            player.send_msg('Sorry, ' + name + NAME_TAKEN_STRING + '\nPlease tell us your name:')
+        else:
+            players_log.info("New connection from: %s", player.name)
+            player.send_msg(INSTRUCTIONS)
 
-        elif "<manual>" in msg:
-            player.socket.sendall(instructions)
-        
-        elif "<quit>" in msg:
-            player.socket.sendall(QUIT_STRING.encode())
-            self.remove_player(player)
+    def join(self, player, arg):
+        room_name, _, count = arg.partition(' ')
+        if not room_name: # error check
+            player.send_msg(INSTRUCTIONS)
+            return
+        # how many past messages to replay, e.g. 0 when a client rejoins
+        # after losing its connection
+        count = count.strip()
+        replay = int(count) if count.isdigit() else None
+        if self.router is not None and not self.router.is_local(room_name):
+            if player.socket is None or player.decompressor is not None:
+                # multiplexed or compressed: its state cannot be handed over
+                player.send_msg('Sorry, room ' + room_name + ' is not available here')
+                return
+            # the room lives in another worker, which takes the player over
+            # (and removes it from this hall, see ShardedServer.hand_off)
+            player.moving = arg
+            return
+        old_room = self.room_player_map.get(player.id)
+        if old_room == room_name:
+            player.send_msg('You are already in room: ' + room_name)
+            return
+        if old_room is not None: # switch
+            self.leave_room(player, old_room)
+        self.empty_rooms.pop(room_name, None)
+        if not room_name in self.rooms: # new room:
+            self.new_room(room_name)
+        self.rooms[room_name].add_player(player, replay)
+        self.room_player_map[player.id] = room_name
+
+    def new_room(self, room_name):
+        room_log = None
+        if self.message_log is not None:
+            room_log = self.message_log.room(room_name)
+        room = Room(room_name, self.codec, History(self.history_size, self.history_bytes),
+                    room_log)
+        room.bucket = self.new_bucket(self.room_rate, self.room_burst)
+        self.rooms[room_name] = room
+        return room
+
+    def show_rooms(self, player, arg):
+        self.list_rooms(player)
 
+    def history(self, player, arg):
+        room_name = self.room_player_map.get(player.id)
+        if room_name is None:
+            player.send_msg('You are currently not in any room!')
+            return
+        try:
+            n = int(arg) if arg else self.history_size
+        except ValueError:
+            player.send_msg('Use [<history> n] to show the last n messages')
+            return
+        self.rooms[room_name].replay(player, n)
+
+    def subscribe(self, player, arg):
+        room_name = self.room_player_map.get(player.id)
+        if room_name is None:
+            player.send_msg('You are currently not in any room!')
+            return
+        room = self.rooms[room_name]
+        if room.matcher is None: # most rooms never have one
+            room.matcher = KeywordMatcher()
+        matcher = room.matcher
+        filters = [(word[1:], True) if word.startswith('^') else (word, False)
+                   for word in arg.split()]
+        filters = [(text.lower(), prefix) for text, prefix in filters
+                   if 0 < len(text) <= MAX_FILTER_LENGTH]
+        if filters:
+            if len(matcher.get(player.id) | set(filters)) > MAX_FILTERS:
+                player.send_msg('Sorry, at most %d subscriptions per player' % MAX_FILTERS)
+                return
+            matcher.add(player.id, filters)
+        if player.id in matcher:
+            player.send_msg('Subscribed to ' + ' '.join(sorted(
+                ('^' if prefix else '') + text for text, prefix in matcher.get(player.id))))
         else:
-            # check if in a room or not first
-            if player.name in self.room_player_map:
-                self.rooms[self.room_player_map[player.name]].broadcast(player, msg.encode())
+            room.unsubscribe(player)
+            player.send_msg('Use [<subscribe> word ^start] to only get the messages with a word')
+
+    def unsubscribe(self, player, arg):
+        room_name = self.room_player_map.get(player.id)
+        if room_name is None:
+            player.send_msg('You are currently not in any room!')
+            return
+        self.rooms[room_name].unsubscribe(player)
+        player.send_msg('Unsubscribed, you get every message of room ' + room_name)
+
+    def manual(self, player, arg):
+        player.send_msg(INSTRUCTIONS)
+
+    def quit(self, player, arg):
+        player.send_msg(QUIT_STRING)
+        self.remove_player(player)
+
+    def stats(self, player, arg):
+        if self.metrics is None:
+            player.send_msg('Statistics are not enabled')
+        elif is_local(player) or (self.admin_secret and # messages arrive lowercased
+                                  hmac.compare_digest(arg.encode(),
+                                                      self.admin_secret.lower().encode())):
+            player.send_msg(self.metrics.report(self))
+        else:
+            player.send_msg('Sorry, <stats> is for administrators')
+
+    def compress(self, player, arg):
+        if player.socket is None or player.decompressor is not None:
+            return
+        player.send_msg(COMPRESS_ACK) # the last message sent uncompressed
+        player.start_compression()
+
+    def mux(self, player, arg):
+        if player.socket is None or player.mux is not None:
+            return
+        player.send_msg(MUX_ACK) # the last message framed by the codec
+        self.start_mux(player)
+
+    def start_mux(self, link):
+        link.mux = {} # {channel: ChannelPlayer}
+        link.decoder = MuxDecoder()
+        # charged for what every channel says, see ChannelPlayer.may_say
+        link.bucket = self.new_bucket(self.flood_rate * self.max_channels,
+                                      self.flood_burst * self.max_channels)
+
+    def say(self, player, msg):
+        # only what is said is limited: commands, e.g. a bridge resuming its
+        # session, always go through
+        if not player.may_say(time.monotonic()):
+            self.suppress(player, 'player')
+            return
+        # check if in a room or not first
+        room_name = self.room_player_map.get(player.id)
+        if room_name is not None:
+            room = self.rooms[room_name]
+            if room.bucket is not None and not room.bucket.take(time.monotonic()):
+                self.suppress(player, 'room')
+                return
+            if player.suppressed:
+                room.announce('[%d message(s) from %s suppressed]' % (player.suppressed, player.name))
+                player.suppressed = 0
+            recipient = None
+            if self.mentions == MENTIONS_DIRECT:
+                match = MENTION_RE.match(msg)
+                # mentioning someone who is not in the room is just text
+                recipient = match and self.names.get(match.group(1))
+            if recipient and recipient.id in room.players:
+                room.whisper(player, recipient, msg, self.mention_echo)
             else:
-                msg = 'You are currently not in any room! \n' \
-                    + 'Use [<list>] to see available rooms! \n' \
-                    + 'Use [<join> room_name] to join a room! \n'
-                player.socket.sendall(msg.encode())
-    
+                room.broadcast(player, msg)
+            if self.metrics is not None:
+                self.metrics.message(room_name)
+        else:
+            msg = 'You are currently not in any room! \n' \
+                + 'Use [<list>] to see available rooms! \n' \
+                + 'Use [<join> room_name] to join a room! '
+            player.send_msg(msg)
+
+    def suppress(self, player, scope):
+        """
+        Drop a message over the flood limit of the player or of its room.
+        """
+        messages_log.debug("%s over the %s limit", player.name, scope)
+        if self.metrics is not None:
+            self.metrics.limited(scope)
+        if self.flood_policy == FLOOD_NOTIFY:
+            player.suppressed += 1 # told to the room with the next message let through
+
     def remove_player(self, player):
-        if player.name in self.room_player_map:
-            self.rooms[self.room_player_map[player.name]].remove_player(player)
-            del self.room_player_map[player.name]
-        print("Player: " + player.name + " has left\n")
+        if player.mux: # a multiplexed connection takes its players along
+            for channel_player in list(player.mux.values()):
+                self.remove_player(channel_player)
+            player.mux.clear()
+        room_name = self.room_player_map.pop(player.id, None)
+        if room_name is not None:
+            self.leave_room(player, room_name)
+        if self.players.pop(player.id, None) is None:
+            return # already removed
+        if self.metrics is not None:
+            self.metrics.disconnections += 1
+        if self.names.get(player.name) is player:
+            del self.names[player.name]
+        players_log.info("Player: %s has left", player.name)
+
+    def leave_room(self, player, room_name):
+        room = self.rooms[room_name]
+        room.remove_player(player)
+        if not room.players:
+            self.empty_rooms[room_name] = time.monotonic()
+
+    def reap(self, now=None):
+        """
+        Drop the rooms empty for more than room_grace seconds. Called
+        regularly by the server loop.
+        """
+        if self.room_grace < 0 or not self.empty_rooms:
+            return
+        if now is None:
+            now = time.monotonic()
+        while self.empty_rooms:
+            room_name, since = next(iter(self.empty_rooms.items()))
+            if now - since < self.room_grace:
+                break
+            room = self.rooms[room_name]
+            if room.log is not None and room.log.written_seq < room.log.next_seq:
+                break # not written out yet, or it would be opened twice
+            del self.empty_rooms[room_name]
+            del self.rooms[room_name]
+            if self.message_log is not None:
+                self.message_log.release(room_name)
+            if self.metrics is not None:
+                self.metrics.reaped(room_name)
+            log.debug("Room %s reaped", room_name)
+
+    def snapshot(self):
+        """
+        State of the hall for a hot restart (see pychat_server): rooms with
+        their history, players with their names, rooms and buffered bytes.
+        Compressed players are left out: a zlib stream cannot be saved.
+        @return: (snapshot, sockets), the snapshot made of JSON types, and
+                 the sockets of its players, in the same order
+        """
+        players, sockets = [], []
+        for player in self.players.values():
+            if player.socket is None or player.evicted or player.decompressor is not None:
+                continue # channels are saved with their link
+            state = self.player_state(player)
+            if player.mux is not None:
+                state['channels'] = [dict(self.player_state(channel_player), channel=channel)
+                                     for channel, channel_player in player.mux.items()]
+            players.append(state)
+            sockets.append(player.socket)
+        rooms = []
+        for room_name, room in self.rooms.items():
+            rooms.append({
+                'name': room_name,
+                'history': [bytes(frame).decode('latin-1') for frame in room.history.frames],
+                'players': list(room.players),
+                'subscriptions': {player_id: sorted(filters) for player_id, filters
+                                  in (room.matcher.filters.items() if room.matcher else ())},
+            })
+        return {'framing': self.codec.name, 'rooms': rooms, 'players': players}, sockets
+
+    def player_state(self, player):
+        # raw bytes, latin-1 maps them one to one
+        return {
+            'id': player.id,
+            'name': player.name,
+            'named': self.names.get(player.name) is player,
+            'inbuf': bytes(player.decoder.buffer).decode('latin-1'),
+            'outbuf': player.outbox.peek().decode('latin-1'),
+        }
+
+    def restore(self, snapshot, sockets):
+        """
+        Take over the state saved by snapshot() in another process.
+        Players get new ids.
+        @param sockets: The sockets of the players of the snapshot
+        @return: The players restored with their socket
+        """
+        restored = []
+        by_id = {} # {id in the snapshot: Player}
+        for state, sock in zip(snapshot['players'], sockets):
+            player = self.new_player(sock)
+            if 'channels' in state:
+                self.start_mux(player)
+                for channel_state in state['channels']:
+                    channel = channel_state['channel']
+                    player.mux[channel] = self.new_channel_player(player, channel)
+                    self.restore_player(player.mux[channel], channel_state, by_id)
+            self.restore_player(player, state, by_id)
+            restored.append(player)
+        now = time.monotonic()
+        for room_state in snapshot['rooms']:
+            room = self.new_room(room_state['name'])
+            for frame in room_state['history']:
+                room.history.append(frame.encode('latin-1'))
+            for player_id in room_state['players']:
+                player = by_id.get(player_id)
+                if player is not None: # else compressed, and gone
+                    room.players[player.id] = player
+                    self.room_player_map[player.id] = room.name
+            for player_id, filters in room_state['subscriptions'].items():
+                player = by_id.get(int(player_id)) # JSON keys are strings
+                if player is not None and player.id in room.players:
+                    if room.matcher is None:
+                        room.matcher = KeywordMatcher()
+                    room.matcher.add(player.id, [tuple(key) for key in filters])
+            if not room.players:
+                self.empty_rooms[room.name] = now
+        return restored
+
+    def restore_player(self, player, state, by_id):
+        player.name = state['name']
+        if state['named']:
+            self.names[player.name] = player
+        # only an incomplete frame is ever left in the buffer
+        player.decoder.feed(state['inbuf'].encode('latin-1'))
+        if state.get('outbuf'):
+            player.send(state['outbuf'].encode('latin-1'))
+        by_id[state['id']] = player
+
+    # commands are looked up by their first word, see handle_msg
+    command_dict = { 'name:': set_player_name, '<join>': join,
+                     '<list>': show_rooms, '<history>': history,
+                     '<manual>': manual, '<quit>': quit, '<stats>': stats,
+                     '<subscribe>': subscribe, '<unsubscribe>': unsubscribe,
+                     MUX_COMMAND: mux, COMPRESS_COMMAND: compress }
 
     
+def is_local(player):
+    """
+    True if the player is connected from this machine.
+    """
+    if player.socket is None: # multiplexed: a bridge speaks for it
+        return False
+    try:
+        host = player.socket.getpeername()[0]
+    except (OSError, IndexError, TypeError): # e.g. a Unix socket
+        return False
+    try:
+        address = ipaddress.ip_address(host.split('%')[0])
+    except ValueError:
+        return False
+    if getattr(address, 'ipv4_mapped', None):
+        address = address.ipv4_mapped
+    return address.is_loopback
+
+
 class Room:
-    def __init__(self, name):
-        self.players = [] # a list of sockets
+    __slots__ = ('players', 'name', 'codec', 'history', 'log', 'bucket', 'matcher')
+
+    def __init__(self, name, codec=DEFAULT_CODEC, history=None, log=None):
+        self.players = {} # {player_id: Player}, in order of arrival
         self.name = name
+        self.codec = codec
+        self.history = history if history is not None else History()
+        self.log = log
+        self.bucket = None # TokenBucket of the messages said, set by the Hall
+        self.matcher = None # KeywordMatcher of the subscribed players, by id
+
+    def add_player(self, player, replay=None):
+        self.replay(player, replay) # catch up on what was said before
+        self.players[player.id] = player
+        self.welcome_new(player)
+
+    def replay(self, player, n=None):
+        if n is None:
+            n = self.history.frames.maxlen
+        n = min(n, MAX_REPLAY)
+        frames = self.history.last(n)
+        if self.log is not None and len(frames) < n:
+            # older messages, e.g. from before a restart, come from the log
+            frames = self.log.read(self.log.next_seq - len(frames), n - len(frames)) + frames
+        for frame in frames: # the flush gathers them in one write
+            player.send(frame)
 
     def welcome_new(self, from_player):
-        msg = self.name + " welcomes: " + from_player.name + '\n'
-        for player in self.players:
-            player.socket.sendall(msg.encode())
+        msg = self.codec.encode(self.name + " welcomes: " + from_player.name)
+        for player in self.players.values():
+            player.send(msg)
     
     def broadcast(self, from_player, msg):
-        msg = from_player.name.encode() + b":" + msg
-        for player in self.players:
-            player.socket.sendall(msg)
+        frame = self.codec.encode(from_player.name + ":" + msg)
+        self.history.append(frame)
+        if self.log is not None:
+            self.log.append(frame)
+        if not self.matcher: # None or empty
+            for player in self.players.values():
+                player.send(frame)
+            return
+        # one pass over the message, however many subscriptions
+        matched = self.matcher.match(msg)
+        for player in self.players.values():
+            if player.id in matched or player.id not in self.matcher:
+                player.send(frame)
+
+    def announce(self, msg):
+        """
+        Send a notice from the server to the room. It is not kept in the history.
+        """
+        msg = self.codec.encode(msg)
+        for player in self.players.values():
+            player.send(msg)
+
+    def unsubscribe(self, player):
+        if self.matcher is not None:
+            self.matcher.remove(player.id)
+            if not self.matcher:
+                self.matcher = None
+
+    def whisper(self, from_player, to_player, msg, echo=True):
+        """
+        Send a message to one player only. It is not kept in the history.
+        """
+        msg = self.codec.encode(from_player.name + ":" + msg)
+        to_player.send(msg)
+        if echo and from_player is not to_player:
+            from_player.send(msg)
 
     def remove_player(self, player):
-        self.players.remove(player)
-        leave_msg = player.name.encode() + b" has left the room\n"
-        self.broadcast(player, leave_msg)
+        del self.players[player.id]
+        self.unsubscribe(player) # subscriptions are for this room only
+        # said as before, but neither kept nor replayed to who joins later
+        self.announce(player.name + ":" + player.name + " has left the room")
+
+class TokenBucket:
+    """
+    Allows rate events per second on average, in bursts of up to burst.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'last')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+
+    def take(self, now):
+        """
+        @return: Whether the event is allowed (and counted)
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class KeywordMatcher:
+    """
+    Finds the subscribers a message is for, in one pass over the message
+    whatever the number of subscriptions (Aho-Corasick automaton). Filters
+    are (text, prefix) pairs: the text is looked for anywhere in the
+    message, or only at its start if prefix is true; case is ignored.
+    Filters are added to the trie as they come, and the failure links are
+    computed again at the next match after a change.
+    """
+
+    def __init__(self):
+        self.filters = {} # {subscriber: set of filters}
+        self.subscribers = {} # {filter: set of subscribers}
+        self.clear()
+
+    def clear(self):
+        self.goto = [{}] # {char: node} of each node, the root is 0
+        self.ends = [[]] # filters ending at each node
+        self.fail = [0]
+        self.found = [[]] # filters ending at each node, or at a suffix of it
+        self.linked = True
+        self.keys = set() # filters in the trie, some maybe without subscribers
+
+    def __len__(self):
+        return len(self.filters)
+
+    def __contains__(self, subscriber):
+        return subscriber in self.filters
+
+    def get(self, subscriber):
+        return self.filters.get(subscriber, set())
+
+    def add(self, subscriber, filters):
+        mine = self.filters.setdefault(subscriber, set())
+        for key in filters:
+            if key in mine:
+                continue
+            mine.add(key)
+            holders = self.subscribers.get(key)
+            if holders is None:
+                holders = self.subscribers[key] = set()
+                if key not in self.keys:
+                    self.insert(key)
+            holders.add(subscriber)
+
+    def remove(self, subscriber):
+        for key in self.filters.pop(subscriber, ()):
+            holders = self.subscribers[key]
+            holders.discard(subscriber)
+            if not holders:
+                del self.subscribers[key]
+        if len(self.keys) > 2 * len(self.subscribers): # mostly dead branches: start over
+            self.clear()
+            for key in self.subscribers:
+                self.insert(key)
+
+    def insert(self, key):
+        node = 0
+        for char in key[0]:
+            child = self.goto[node].get(char)
+            if child is None:
+                child = self.goto[node][char] = len(self.goto)
+                self.goto.append({})
+                self.ends.append([])
+                self.fail.append(0)
+                self.found.append([])
+            node = child
+        self.ends[node].append(key)
+        self.keys.add(key)
+        self.linked = False
+
+    def link(self):
+        """
+        Compute the failure links, breadth first.
+        """
+        goto, fail, found = self.goto, self.fail, self.found
+        found[0] = self.ends[0]
+        queue = deque()
+        for child in goto[0].values():
+            fail[child] = 0
+            found[child] = self.ends[child]
+            queue.append(child)
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[child] = goto[state].get(char, 0)
+                found[child] = self.ends[child] + found[fail[child]]
+                queue.append(child)
+        self.linked = True
+
+    def match(self, text):
+        """
+        @return: The subscribers with a filter matching text
+        """
+        if not self.linked:
+            self.link()
+        goto, fail, found = self.goto, self.fail, self.found
+        matched = set()
+        node = 0
+        for i, char in enumerate(text.lower()):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for key in found[node]:
+                if not key[1] or i + 1 == len(key[0]):
+                    matched.update(self.subscribers.get(key, ()))
+        return matched
+
+class History:
+    """
+    Ring buffer of the last frames broadcast in a room, bounded both in
+    number of messages and in bytes.
+    """
+
+    __slots__ = ('frames', 'bytes', 'max_bytes')
+
+    def __init__(self, size=HISTORY_SIZE, max_bytes=HISTORY_BYTES):
+        self.frames = deque(maxlen=size)
+        self.bytes = 0
+        self.max_bytes = max_bytes
+
+    def __len__(self):
+        return len(self.frames)
+
+    def append(self, frame):
+        if len(frame) > self.max_bytes:
+            # the history must stay the most recent messages, without holes
+            self.frames.clear()
+            self.bytes = 0
+            return
+        if self.frames.maxlen == 0:
+            return
+        if len(self.frames) == self.frames.maxlen: # the oldest one goes
+            self.bytes -= len(self.frames[0])
+        self.frames.append(frame)
+        self.bytes += len(frame)
+        while self.bytes > self.max_bytes:
+            self.bytes -= len(self.frames.popleft())
+
+    def last(self, n=None):
+        if n is None or n >= len(self.frames):
+            return list(self.frames)
+        if n <= 0:
+            return []
+        return list(itertools.islice(self.frames, len(self.frames) - n, None))
+
 
 class Player:
-    def __init__(self, socket, name = "new"):
-        socket.setblocking(0)
+    # one per connection, which a big event has many of
+    __slots__ = ('socket', 'name', 'codec', 'decoder', 'outbox', 'pending', 'evicted',
+                 'moving', 'unhandled', 'id', 'mux', 'decompressor', 'bucket', 'suppressed')
+
+    def __init__(self, socket, name = "new", outbox = None, pending = None,
+                 codec = DEFAULT_CODEC):
+        if socket is not None: # None for a multiplexed channel
+            socket.setblocking(0)
         self.socket = socket
         self.name = name
+        self.codec = codec
+        self.decoder = codec.decoder()
+        self.outbox = outbox if outbox is not None else Outbox()
+        self.pending = pending # set shared with the Hall, flushed by the server loop
+        self.evicted = False
+        self.moving = None # <join> argument for a room owned by another worker
+        self.unhandled = [] # messages left for that worker
+        self.id = None # connection id, given by the Hall
+        self.mux = None # {channel: ChannelPlayer} once multiplexed
+        self.decompressor = None # once compressed, see COMPRESS_COMMAND
+        self.bucket = None # TokenBucket of the messages, set by the Hall
+        self.suppressed = 0 # messages dropped since the last notice
 
     def fileno(self):
         return self.socket.fileno()
+
+    def send(self, data):
+        """
+        Queue data for this player. Nothing is written here: the server
+        loop flushes the queue when the socket is writable, so a stalled
+        client never blocks (or breaks) the fan-out to the others.
+        """
+        if self.evicted:
+            return
+        if not self.outbox.push(data):
+            self.evicted = True
+        if self.pending is None:
+            self.flush()
+        else:
+            self.pending.add(self)
+
+    def send_msg(self, msg):
+        self.send(self.codec.encode(msg))
+
+    def may_say(self, now):
+        # flood control, see FLOOD_RATE
+        return self.bucket is None or self.bucket.take(now)
+
+    def start_compression(self):
+        # what is already queued is sent uncompressed
+        self.outbox.sealed = len(self.outbox.chunks)
+        self.outbox.compressor = new_compressor()
+        self.decompressor = new_decompressor()
+
+    def flush(self, stats=None):
+        try:
+            self.outbox.flush(self.socket, stats)
+        except OSError:
+            self.evicted = True
+
+
+class IOStats:
+    """
+    Counters for the outbound path: comparing frames with write calls
+    shows how many syscalls the gathered writes saved.
+    """
+
+    def __init__(self):
+        self.frames = 0 # messages written out
+        self.writes = 0 # send/sendmsg syscalls
+        self.bytes = 0
+
+    def saved(self):
+        return self.frames - self.writes
+
+    def __str__(self):
+        return '{} frames, {} bytes in {} writes ({} syscalls saved)'.format(
+            self.frames, self.bytes, self.writes, self.saved())
+
+
+class Outbox:
+    """
+    Bounded queue of bytes waiting to be written to a non-blocking socket.
+    When the limit is reached, the oldest messages are dropped (DROP_OLDEST),
+    or push() returns False so that the caller disconnects the player
+    (DISCONNECT).
+    """
+
+    __slots__ = ('chunks', 'size', 'sent', 'limit', 'policy', 'dropped', 'compressor', 'sealed')
+
+    def __init__(self, limit = MAX_OUTBOUND, policy = DROP_OLDEST):
+        self.chunks = deque()
+        self.size = 0
+        self.sent = 0 # bytes of chunks[0] already written
+        self.limit = limit
+        self.policy = policy
+        self.dropped = 0 # messages dropped for this player
+        self.compressor = None # zlib stream, see COMPRESS_COMMAND
+        self.sealed = 0 # leading chunks already compressed, never dropped
+
+    def __len__(self):
+        return self.size
+
+    def take(self):
+        """
+        Remove and return all the bytes not written yet.
+        """
+        data = self.peek()
+        self.chunks.clear()
+        self.size = 0
+        self.sent = 0
+        return data
+
+    def peek(self):
+        """
+        Return all the bytes not written yet, and leave them queued.
+        """
+        if not self.chunks:
+            return b''
+        return bytes(memoryview(self.chunks[0])[self.sent:]) \
+            + b''.join(itertools.islice(self.chunks, 1, None))
+
+    def push(self, data):
+        if self.size + len(data) > self.limit:
+            if self.policy == DISCONNECT:
+                return False
+            self.shrink(self.limit - len(data))
+            if self.size + len(data) > self.limit:
+                self.dropped += 1
+                return True
+        self.chunks.append(data)
+        self.size += len(data)
+        return True
+
+    def shrink(self, size):
+        """
+        Drop the oldest messages until at most size bytes are queued, or
+        only those that cannot be dropped are left.
+        """
+        # never drop a partially written message, it would corrupt the stream
+        keep = max(1 if self.sent else 0, self.sealed)
+        while len(self.chunks) > keep and self.size > size:
+            old = self.chunks[keep]
+            del self.chunks[keep]
+            self.size -= len(old)
+            self.dropped += 1
+
+    def flush(self, sock, stats=None):
+        """
+        Write out as much as the socket accepts, gathering all the queued
+        frames in a single sendmsg() call. The frames are shared between
+        all the members of a room, and are never copied here.
+        A compressed stream is written one compressed batch at a time: the
+        frames queued meanwhile can still be dropped.
+        """
+        while self.chunks:
+            end = MAX_IOV
+            if self.compressor is not None:
+                if not self.sealed:
+                    self.compress()
+                end = min(self.sealed, MAX_IOV)
+            buffers = [memoryview(self.chunks[0])[self.sent:]]
+            buffers.extend(itertools.islice(self.chunks, 1, end))
+            try:
+                if HAS_SENDMSG:
+                    n = sock.sendmsg(buffers)
+                else:
+                    n = sock.send(buffers[0])
+            except (BlockingIOError, InterruptedError):
+                return
+            self.size -= n
+            if stats is not None:
+                stats.writes += 1
+                stats.bytes += n
+            n += self.sent
+            while self.chunks and n >= len(self.chunks[0]):
+                n -= len(self.chunks.popleft())
+                if self.sealed:
+                    self.sealed -= 1
+                if stats is not None:
+                    stats.frames += 1
+            self.sent = n
+            if n:
+                return # socket buffer full
+
+    def compress(self):
+        # all the queued frames, in one chunk (counted as one frame)
+        data = compress_frames(self.compressor, self.chunks)
+        self.chunks.clear()
+        self.chunks.append(data)
+        self.size = len(data)
+        self.sealed = 1
+
+
+# the outbox of the multiplexed channels, which queue into their link: always empty
+NO_OUTBOX = Outbox(0)
+
+
+class ChannelPlayer(Player):
+    """
+    A player whose stream is one channel of a multiplexed connection
+    (the link, see MUX_COMMAND), e.g. one Scratch session of a shared bridge.
+    """
+
+    __slots__ = ('link', 'channel')
+
+    def __init__(self, link, channel, codec = DEFAULT_CODEC):
+        # what is sent is queued in the outbox of the link, and compressed
+        # with it, if it is
+        Player.__init__(self, None, outbox=NO_OUTBOX, codec=codec)
+        self.link = link
+        self.channel = channel
+
+    def send(self, data):
+        # header and data in one chunk: the link's outbox may drop whole
+        # chunks, never half of one
+        self.link.send(mux_chunk(self.channel, data))
+
+    def may_say(self, now):
+        # a new channel has a full bucket: the link's keeps it from being
+        # a way around the limit
+        return Player.may_say(self, now) and self.link.may_say(now)
+
+    def close(self):
+        self.link.send(mux_chunk(self.channel))
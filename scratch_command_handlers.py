@@ -25,13 +25,41 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 """
 
-import datetime, logging, re, select, socket, sys
+import json, logging, random, socket, sys, threading, time, zlib
+from collections import OrderedDict, deque
 from urllib import parse
 from pychat.pychat_util import Room, Hall, Player
 from pychat import pychat_util
+import scratch_upstream
 
 READ_BUFFER = 4096
 END_OF_LINE = '\n'
+INBOUND_QUEUE = 100 # messages kept for the "next message" block
+MENTION_CAPACITY = 200 # recipients kept for the "last message for" block
+MENTION_TTL = 0 # seconds before a mention is forgotten, 0 to keep it
+BATCH_WINDOW = 0.02 # seconds messages wait to be sent together, 0 to send at once
+OUTGOING_QUEUE = 100 # messages kept while connecting, or while the pychat server is slow
+STREAM_BUFFER = 100 # events kept for an /events client that does not keep up
+SESSION_IDLE = 600 # seconds without a request before a shared bridge drops a session
+MAX_SESSIONS = 1000 # sessions of a shared bridge, past it the least recently used is dropped
+
+# states of the connection to the pychat server, reported by poll
+DISCONNECTED = 'disconnected'
+CONNECTING = 'connecting'
+CONNECTED = 'connected'
+RECONNECTING = 'reconnecting'
+NAME_TAKEN = 'name taken' # by another user: tried again, like a lost connection
+CONNECT_TIMEOUT = 5 # seconds to connect and be asked for a name
+RECONNECT_DELAY = 0.5 # before the first new attempt, doubled after each failure
+RECONNECT_MAX_DELAY = 30
+
+# log categories, see pychat_logging: pass values as arguments, not formatted
+log = logging.getLogger('scratchat')
+commands_log = logging.getLogger('scratchat.commands')
+chat_log = logging.getLogger('scratchat.chat')
+
+class NameTaken(Exception):
+    pass
 
 def bool2str(b):
     if b:
@@ -39,6 +67,151 @@ def bool2str(b):
     return 'false'
 
 
+class PollPayload:
+    """
+    The lines of the poll response, each encoded only when its value
+    changes. The whole response is rebuilt only after a change, otherwise
+    the cached one is returned.
+    """
+
+    __slots__ = ('lines', 'deltas', 'cache', 'hits', 'rebuilds')
+
+    def __init__(self):
+        self.lines = {} # {name: 'name value\n'}, in order of first appearance
+        self.deltas = {} # {name: 'name value\n'}, sent by the next poll only
+        self.cache = None
+        self.hits = 0
+        self.rebuilds = 0
+
+    def set(self, name, value):
+        """
+        @param value: The value, already encoded for Scratch
+        """
+        line = name + ' ' + value + END_OF_LINE
+        if self.lines.get(name) != line:
+            self.lines[name] = line
+            self.cache = None
+
+    def set_once(self, name, value):
+        """
+        Send a line with the next poll only: Scratch keeps the value
+        until it is sent again.
+        """
+        self.deltas[name] = name + ' ' + value + END_OF_LINE
+
+    def remove(self, name):
+        if self.lines.pop(name, None) is not None:
+            self.cache = None
+
+    def render(self):
+        if self.cache is None:
+            self.cache = ''.join(self.lines.values())
+            self.rebuilds += 1
+        else:
+            self.hits += 1
+        if self.deltas:
+            deltas = ''.join(self.deltas.values())
+            self.deltas.clear()
+            return self.cache + deltas + 'okay'
+        return self.cache + 'okay'
+
+
+class MentionTable:
+    """
+    The last message for each recipient, for at most capacity recipients:
+    the one mentioned least recently is forgotten first. With a ttl,
+    a mention is also forgotten ttl seconds after it was received.
+    """
+
+    __slots__ = ('capacity', 'ttl', 'entries')
+
+    def __init__(self, capacity=MENTION_CAPACITY, ttl=MENTION_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = OrderedDict() # {recipient: (message, time)}, oldest first
+
+    def __contains__(self, recipient):
+        return recipient in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, recipient):
+        entry = self.entries.get(recipient)
+        return entry and entry[0]
+
+    def put(self, recipient, message):
+        """
+        @return: The recipients forgotten to make room
+        """
+        self.entries[recipient] = (message, time.monotonic())
+        self.entries.move_to_end(recipient)
+        evicted = []
+        while len(self.entries) > self.capacity:
+            evicted.append(self.entries.popitem(last=False)[0])
+        return evicted
+
+    def expire(self):
+        """
+        @return: The recipients forgotten because their mention is too old
+        """
+        expired = []
+        if self.ttl > 0:
+            deadline = time.monotonic() - self.ttl
+            while self.entries:
+                recipient, (message, received) = next(iter(self.entries.items()))
+                if received > deadline:
+                    break
+                del self.entries[recipient]
+                expired.append(recipient)
+        return expired
+
+
+def sse_event(event, data):
+    # JSON has no newline: the data fits on one line
+    return ('event: %s\ndata: %s\n\n' % (event, json.dumps(data))).encode()
+
+
+class EventStream:
+    """
+    The events for one client of /events (server-sent events, see
+    scratch_http_server): put by the reader thread, taken by the thread of
+    the HTTP connection. When the client does not keep up, the oldest are
+    dropped, and a "dropped" event tells how many.
+    """
+
+    __slots__ = ('capacity', 'events', 'dropped', 'condition')
+
+    def __init__(self, capacity=STREAM_BUFFER):
+        self.capacity = capacity
+        self.events = deque() # encoded by sse_event
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def put(self, event):
+        with self.condition:
+            if len(self.events) == self.capacity:
+                self.events.popleft()
+                self.dropped += 1
+            self.events.append(event)
+            self.condition.notify()
+
+    def take(self, timeout):
+        """
+        Wait up to timeout seconds for events.
+        @return: The events, encoded, empty if none came
+        """
+        with self.condition:
+            if not self.events:
+                self.condition.wait(timeout)
+            data = b''.join(self.events)
+            self.events.clear()
+            if self.dropped:
+                data = sse_event('dropped', self.dropped) + data
+                self.dropped = 0
+            return data
+
+
 class ScratchCommandHandlers:
     """
     This class processes any command received from Scratch 2.0
@@ -49,20 +222,151 @@ class ScratchCommandHandlers:
     descriptor file.
     """
 
-    def __init__(self, chatserver):
+    # one instance per Scratch session, which a shared bridge has many of
+    __slots__ = ('debug', 'lock', 'first_poll_received', 'chatserver', 'codec',
+                 'upstream', 'compress', 'server_connection', 'username', 'room', 'last_message',
+                 'last_message_for', 'last_speaker', 'message_contains_text', 'inbound',
+                 'dropped_messages', 'current_speaker', 'current_message', 'payload',
+                 'batch_window', 'outgoing', 'resuming', 'batch_deadline', 'send_requested',
+                 'detached',
+                 'sender', 'sending', 'wakeup', 'closed', 'sent_messages', 'sent_writes',
+                 'connection_state', 'attempt', 'keywords', 'stream_buffer', 'streams',
+                 'published_state')
+
+    def __init__(self, chatserver, codec=pychat_util.DEFAULT_CODEC, upstream=None,
+                 mention_capacity=MENTION_CAPACITY, mention_ttl=MENTION_TTL, compress=False,
+                 batch_window=BATCH_WINDOW, stream_buffer=STREAM_BUFFER):
         """
         The class constructor
+        @param upstream: UpstreamPool to share connections with other
+                         sessions, or None for a connection of our own
+        @param mention_capacity: Recipients kept for "last message for"
+        @param mention_ttl: Seconds a mention is kept, 0 for no limit
+        @param compress: Ask the pychat server to compress the connection
+                         (a shared connection is compressed by the UpstreamPool)
+        @param batch_window: Seconds the messages said wait for others, to
+                             be sent in one write (or until the next poll)
+        @param stream_buffer: Events kept for each /events client
         """
         self.debug = 'On'
+        # commands run in the threads of the HTTP server
+        self.lock = threading.Lock()
         self.first_poll_received = False
         self.chatserver = chatserver
+        self.codec = codec
+        self.upstream = upstream
+        self.compress = compress
         self.server_connection = None
         self.username = None
         self.room = None
         self.last_message = None
-        self.last_message_for = {}
+        self.last_message_for = MentionTable(mention_capacity, mention_ttl)
         self.last_speaker = None
         self.message_contains_text = False
+        self.inbound = deque() # (speaker, message) received, not taken yet
+        self.dropped_messages = 0
+        self.current_speaker = None
+        self.current_message = None
+        self.payload = PollPayload()
+        self.batch_window = batch_window
+        self.outgoing = [] # encoded messages for the pychat server, not sent yet
+        self.resuming = 0 # lines at the head of outgoing that restore the session, never dropped
+        self.batch_deadline = 0 # when the batch in outgoing is sent
+        self.send_requested = False # send the batch now
+        self.detached = deque() # (connection, data or None to shut it down, count), see detach
+        self.sender = None # thread writing to the pychat server, see sender_loop
+        self.sending = False # the sender is writing, without the lock
+        self.wakeup = threading.Condition(self.lock) # for the sender
+        self.closed = False # see close
+        self.sent_messages = 0
+        self.sent_writes = 0
+        self.connection_state = DISCONNECTED
+        self.attempt = 0 # incremented to cancel the connector thread
+        self.keywords = [] # subscribed to in the room, see subscribe
+        self.stream_buffer = stream_buffer
+        self.streams = [] # EventStreams of the /events clients
+        self.published_state = None # the last "state" event
+        self.changed(*self.poll_fields)
+
+    # state fields reported by poll, in this order
+    poll_fields = ('connected', 'connection_state', 'username', 'room', 'last_speaker',
+                   'last_message', 'contains_text', 'current_speaker', 'current_message',
+                   'queue_depth', 'dropped_messages')
+
+    def changed(self, *fields):
+        """
+        Update the poll lines of the given fields, after they changed.
+        @param fields: Names from poll_fields
+        """
+        for field in fields:
+            if field == 'connected':
+                value = bool2str(self.server_connection)
+            elif field == 'contains_text':
+                value = bool2str(self.message_contains_text)
+            elif field == 'queue_depth':
+                value = str(len(self.inbound))
+            elif field == 'dropped_messages':
+                value = str(self.dropped_messages)
+            else:
+                value = parse.quote(getattr(self, field) or ' ')
+            self.payload.set(field, value)
+        if 'username' in fields:
+            self.changed_mention(self.username)
+        if self.streams and not self.state_fields.isdisjoint(fields):
+            state = self.state()
+            if state != self.published_state: # e.g. closing an unused connection
+                self.published_state = state
+                self.publish('state', state)
+
+    # fields of the "state" event of /events
+    state_fields = frozenset(('connection_state', 'username', 'room'))
+
+    def state(self):
+        return {'connection_state': self.connection_state, 'username': self.username,
+                'room': self.room}
+
+    def publish(self, event, data):
+        """
+        Push an event to the /events clients. Called with the lock held.
+        """
+        encoded = sse_event(event, data)
+        for stream in self.streams:
+            stream.put(encoded)
+
+    def open_stream(self, command):
+        """
+        Register a client of /events: it gets a "state" event at once and
+        on each change of connection, username or room, and a "message"
+        event for each message as soon as it is received.
+        @param command: unused
+        @return: EventStream, to give back to close_stream
+        """
+        stream = EventStream(self.stream_buffer)
+        with self.lock:
+            self.streams.append(stream)
+            self.published_state = self.state()
+            stream.put(sse_event('state', self.published_state))
+        return stream
+
+    def close_stream(self, command, stream):
+        with self.lock:
+            if stream in self.streams:
+                self.streams.remove(stream)
+
+    def changed_mention(self, recipient):
+        """
+        Update the poll lines of the last message for a recipient. They
+        are sent with the next poll only, and an empty value tells Scratch
+        that a forgotten mention is gone.
+        """
+        message = parse.quote(self.last_message_for.get(recipient) or ' ')
+        if recipient is not None:
+            self.payload.set_once('last_message_for/' + parse.quote(recipient), message)
+        if recipient == self.username:
+            if recipient in self.last_message_for:
+                self.payload.set('last_message_for_me', message)
+            else:
+                self.payload.remove('last_message_for_me')
 
     def do_command(self, command):
         """
@@ -77,42 +381,180 @@ class ScratchCommandHandlers:
         if command[0] != 'poll':
             # turn on debug logging if requested
             if self.debug == 'On':
-                debug_string = 'DEBUG: '
-                debug_string += str(datetime.datetime.now())
-                debug_string += ": "
-                for data in command:
-                    debug_string += ''.join(map(str, data))
-                    debug_string += ' '
-                logging.debug(debug_string)
-                print(debug_string)
+                commands_log.debug('command: %s', command)
 
-        return method(self, command)
+        with self.lock:
+            return method(self, command)
 
     def connect_as(self, command):
         """
         Command to connect to the pychat server, and announce oneself
         with a given username (handle).
+        It returns at once: a thread of its own connects, and then joins
+        the room given meanwhile and sends what was said meanwhile.
         @param command: List of which the 2nd element should be the username/handle
         @return: 'okay'
         """
         username = parse.unquote(command[1])
-        print('connect as {}'.format(username))
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.connect((self.chatserver, pychat_util.PORT))
-        msg = s.recv(READ_BUFFER)
-        if not msg:
-            print('Server down!')
-        else:
-            if 'Please tell us your name' in msg.decode():
-                msg = 'name: {}'.format(username)
-                s.sendall(msg.encode())
+        log.info('connect as %s', username)
+        self.close_connection() # what was said before goes out on the old connection
+        self.username = username
+        self.room = None
+        self.keywords = []
+        self.changed('username', 'room')
+        self.start_connecting(CONNECTING)
+        return 'okay'
+
+    def start_connecting(self, state):
+        """
+        Start a connector thread, which replaces any previous one.
+        Called with the lock held.
+        """
+        self.attempt += 1
+        self.set_state(state)
+        threading.Thread(target=self.connect, args=(self.attempt, state == RECONNECTING),
+                         daemon=True).start()
+
+    def set_state(self, state):
+        self.connection_state = state
+        self.changed('connection_state')
+
+    def connect(self, attempt, wait):
+        """
+        Connector thread: connect to the pychat server, announce the
+        username and join the room again, if any. Failed attempts are
+        retried after a delay doubled each time, with jitter so that the
+        sessions of a shared bridge do not all come back at once.
+        @param attempt: Gives up when another attempt has started
+        @param wait: Wait before the first attempt, after a lost connection
+        """
+        delay = RECONNECT_DELAY
+        resumed = wait
+        while True:
+            if wait:
+                time.sleep(delay * random.uniform(0.5, 1.5))
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            wait = True
+            with self.lock:
+                if self.attempt != attempt:
+                    return
+                username = self.username
+            try:
+                s, decoder = self.open_connection(username)
+            except NameTaken:
+                log.warning('The name %s is already taken', username)
+                with self.lock:
+                    if self.attempt == attempt:
+                        self.set_state(NAME_TAKEN)
+                continue
+            except (OSError, zlib.error, pychat_util.FrameError) as e:
+                log.warning('Cannot connect to the pychat server: %s', e)
+                continue
+            with self.lock:
+                if self.attempt != attempt: # reset, or connecting as someone else
+                    s.close()
+                    return
+                # ahead of what was said meanwhile
+                resume = []
+                if self.room is not None:
+                    # its history was received before the connection was lost
+                    resume.append('<join> {}{}'.format(self.room, ' 0' if resumed else ''))
+                if self.keywords:
+                    resume.append('<subscribe> ' + ' '.join(self.keywords))
+                self.outgoing[:0] = [self.codec.encode(msg) for msg in resume]
+                self.resuming = len(resume)
                 self.server_connection = s
-                self.username = username
-                print('Connected as {}'.format(username))
+                self.set_state(CONNECTED)
+                self.changed('connected')
+                self.send_queued()
+                log.info('Connected as %s', self.username)
+            if self.upstream is not None:
+                s.start(lambda data: self.on_data(s, decoder, data))
             else:
-                print('Server did not as for name!')
-        return 'okay'
+                threading.Thread(target=self.receive, args=(s, decoder), daemon=True).start()
+            return
+
+    def close_connection(self):
+        """
+        Stop using the connection to the pychat server, if any.
+        Called with the lock held.
+        """
+        self.attempt += 1 # and stop connecting
+        self.set_state(DISCONNECTED)
+        if self.server_connection is not None:
+            # shutting it down wakes up its reader thread, which then closes it
+            self.detach(shutdown=True)
+            self.changed('connected')
+
+    def detach(self, shutdown):
+        """
+        Leave the connection to the sender thread, which writes what is
+        still queued for it, and then shuts it down if asked to.
+        Called with the lock held.
+        """
+        if self.outgoing:
+            self.detached.append((self.server_connection, b''.join(self.outgoing),
+                                  len(self.outgoing)))
+            self.outgoing.clear()
+            self.resuming = 0
+        if shutdown:
+            self.detached.append((self.server_connection, None, 0))
+        self.server_connection = None
+        self.start_sender()
+        self.wakeup.notify()
+
+    def compress_connection(self, s):
+        """
+        Ask the pychat server to compress the connection.
+        @return: The connection to use from now on
+        """
+        s.sendall(self.codec.encode(pychat_util.COMPRESS_COMMAND))
+        accepted, received = pychat_util.read_answer(s, self.codec, pychat_util.COMPRESS_ACK)
+        if not accepted: # an older server, which took it for a message
+            log.warning('The server cannot compress the connection')
+            return s
+        return pychat_util.CompressedSocket(s, received)
+
+    def open_connection(self, username):
+        """
+        Connect to the pychat server and announce the username, waiting
+        CONNECT_TIMEOUT seconds at most for each answer.
+        @return: (connection, its frame decoder); the connection is a new
+                 socket, or a channel of a shared connection in a shared bridge
+        @raise NameTaken: The server refused the username
+        """
+        # nothing is sent before the name is accepted: it would be said as "new"
+        accepted = pychat_util.INSTRUCTIONS.rsplit('\n', 1)[-1]
+        if self.upstream is not None:
+            s = self.upstream.open()
+        else:
+            s = socket.create_connection((self.chatserver, pychat_util.PORT), CONNECT_TIMEOUT)
+        try:
+            s.settimeout(CONNECT_TIMEOUT)
+            decoder = self.codec.decoder()
+            msgs = []
+            # the welcome may arrive in several chunks
+            while not any('Please tell us your name' in msg for msg in msgs):
+                data = s.recv(READ_BUFFER)
+                if not data:
+                    raise ConnectionError('the server closed the connection')
+                msgs += decoder.feed(data)
+            if self.compress and self.upstream is None:
+                s = self.compress_connection(s)
+            s.sendall(self.codec.encode('name: {}'.format(username)))
+            msgs = []
+            while not any(accepted in msg for msg in msgs):
+                if any(pychat_util.NAME_TAKEN_STRING in msg for msg in msgs):
+                    raise NameTaken(username)
+                data = s.recv(READ_BUFFER)
+                if not data:
+                    raise ConnectionError('the server closed the connection')
+                msgs += decoder.feed(data)
+            s.settimeout(None)
+        except Exception:
+            s.close()
+            raise
+        return s, decoder
 
     def join_room(self, command):
         """
@@ -121,14 +563,52 @@ class ScratchCommandHandlers:
         @param command: List of which the 2nd element should be the room name
         @return 'okay'
         """
-        if self.server_connection:
-            room = parse.unquote(command[1])
-            print('join room {}'.format(room))
+        if self.connection_state == DISCONNECTED:
+            log.warning('Not connected. Please connect first.')
+            return 'okay'
+        room = parse.unquote(command[1])
+        log.info('join room %s', room)
+        if self.server_connection is not None:
             msg = '<join> {}'.format(room)
-            self.server_connection.sendall(msg.encode())
-            self.room = room
-        else:
-            print('Not connected. Please connect first.')
+            self.send(msg) # after what was said in the previous room
+            self.send_queued()
+        # else joined once connected
+        self.room = room
+        self.keywords = [] # subscriptions are for one room
+        self.changed('room')
+        return 'okay'
+
+    def subscribe(self, command):
+        """
+        Command to receive only the messages of the room containing one of
+        the given words, or starting with one given as ^word. The pychat
+        server filters them, so the others are not even sent to us.
+        @param command: List of which the 2nd element should be the words,
+                        separated by spaces
+        @return: 'okay'
+        """
+        if self.room is None:
+            log.warning('Please join a room before subscribing.')
+            return 'okay'
+        words = [word for word in parse.unquote(command[1]).split()
+                 if word not in self.keywords]
+        if not words:
+            return 'okay'
+        log.info('subscribe to %s', words)
+        self.keywords += words
+        if self.server_connection is not None: # else subscribed once connected
+            self.send('<subscribe> ' + ' '.join(words))
+        return 'okay'
+
+    def unsubscribe(self, command):
+        """
+        Command to receive every message of the room again.
+        @param command: unused
+        @return: 'okay'
+        """
+        self.keywords = []
+        if self.server_connection is not None and self.room is not None:
+            self.send('<unsubscribe>')
         return 'okay'
 
     def say(self, command):
@@ -137,15 +617,15 @@ class ScratchCommandHandlers:
         @param command: List of which the 2nd element should be the message
         @return: 'okay'
         """
-        if self.server_connection is None:
-            print('Not connected. Please connect first.')
+        if self.connection_state == DISCONNECTED:
+            log.warning('Not connected. Please connect first.')
             return
         if self.room is None:
-            print('Please join a room before chatting.')
+            log.warning('Please join a room before chatting.')
             return
-        msg = parse.unquote(command[1]) + END_OF_LINE
-        print('say: "{}"'.format(msg))
-        self.server_connection.sendall(msg.encode())
+        msg = parse.unquote(command[1])
+        log.info('say: "%s"', msg)
+        self.send(msg)
         return 'okay'
 
     def say_to(self, command):
@@ -156,19 +636,129 @@ class ScratchCommandHandlers:
                         and the 3rd element the username/handle of the recipient
         @return: 'okay'
         """
-        if self.server_connection is None:
-            print('Not connected. Please connect first.')
+        if self.connection_state == DISCONNECTED:
+            log.warning('Not connected. Please connect first.')
             return
         if self.room is None:
-            print('Please join a room before chatting.')
+            log.warning('Please join a room before chatting.')
             return
         message = parse.unquote(command[1])
         recipient = parse.unquote(command[2])
-        msg = '@' + recipient + ' ' + message + END_OF_LINE
-        print('say: "{}"'.format(msg))
-        self.server_connection.sendall(msg.encode())
+        msg = '@' + recipient + ' ' + message
+        log.info('say: "%s"', msg)
+        self.send(msg)
         return 'okay'
 
+    def send(self, msg):
+        """
+        Queue a message for the pychat server. The messages queued within
+        batch_window seconds, or until the next poll, are sent in one write.
+        Called with the lock held.
+        """
+        if not self.outgoing:
+            self.batch_deadline = time.monotonic() + self.batch_window
+        self.outgoing.append(self.codec.encode(msg))
+        # kept until connected, or until a slow server takes them
+        if len(self.outgoing) > OUTGOING_QUEUE + self.resuming:
+            del self.outgoing[self.resuming]
+        if self.batch_window <= 0:
+            self.send_queued()
+        elif self.server_connection is not None:
+            self.start_sender()
+            self.wakeup.notify()
+
+    def flush(self):
+        """
+        Send the queued messages now, and wait until they are written (for
+        CONNECT_TIMEOUT seconds at most), e.g. before exiting.
+        """
+        with self.lock:
+            self.send_queued()
+            self.wakeup.wait_for(lambda: not self.sending and not self.detached and
+                                 not (self.outgoing and self.server_connection is not None),
+                                 CONNECT_TIMEOUT)
+
+    def send_queued(self):
+        """
+        Have the sender thread send the queued messages at once, without
+        waiting for the end of the batch window.
+        Called with the lock held.
+        """
+        if self.outgoing and self.server_connection is not None:
+            self.send_requested = True
+            self.start_sender()
+            self.wakeup.notify()
+
+    def close(self):
+        """
+        Leave the pychat server for good: the sender thread ends once it
+        has written what is left.
+        """
+        with self.lock:
+            self.reset_all(None)
+            self.closed = True
+            self.wakeup.notify()
+
+    def start_sender(self):
+        if self.sender is None:
+            self.sender = threading.Thread(target=self.sender_loop, daemon=True)
+            self.sender.start()
+
+    def sender_loop(self):
+        """
+        Sender thread: writes the queued messages to the pychat server, in
+        one write per batch. It writes without the lock, so that a server
+        that does not keep up never holds back the polls.
+        """
+        with self.lock:
+            while True:
+                if self.detached: # a connection left behind, see detach
+                    s, data, count = self.detached.popleft()
+                elif self.outgoing and self.server_connection is not None:
+                    wait = self.batch_deadline - time.monotonic()
+                    if wait > 0 and not self.send_requested:
+                        self.wakeup.wait(wait)
+                        continue
+                    s, data = self.server_connection, b''.join(self.outgoing)
+                    count = len(self.outgoing)
+                    self.outgoing.clear()
+                    self.resuming = 0
+                else:
+                    self.send_requested = False
+                    self.wakeup.notify_all() # flush() may be waiting
+                    if self.closed:
+                        self.sender = None
+                        return
+                    self.wakeup.wait()
+                    continue
+                self.send_requested = False
+                self.sending = True
+                self.lock.release()
+                try:
+                    written = self.write(s, data, count)
+                finally:
+                    self.lock.acquire()
+                    self.sending = False
+                if written and count:
+                    self.sent_messages += count
+                    self.sent_writes += 1
+
+    def write(self, s, data, count):
+        """
+        Called by the sender thread, without the lock.
+        @return: False if the connection failed
+        """
+        try:
+            if data is None:
+                s.shutdown(socket.SHUT_RDWR)
+            else:
+                s.sendall(data)
+        except OSError as e:
+            if data is not None:
+                log.warning('Could not send %d message(s): %s', count, e)
+            return False
+        return True
+
     def check_message_contains(self, command):
         """
         Command to check whether a message contains a given text.
@@ -183,12 +773,32 @@ class ScratchCommandHandlers:
         @return: 'okay'
         """
         self.message_contains_text = False
+        self.changed('contains_text')
         if len(command) != 4:
             return
         unused_command_id = parse.unquote(command[1])
         message = parse.unquote(command[2])
         text_to_find = parse.unquote(command[3])
         self.message_contains_text = text_to_find in message
+        self.changed('contains_text')
+        return 'okay'
+
+    def next_message(self, command):
+        """
+        Command to take the oldest message received and not taken yet,
+        which is then reported by "current message" and "current speaker".
+        Messages are kept in order, even when several arrive between two
+        polls.  Like check_message_contains, this is a "w" (wait) command,
+        so that the new values are polled before the next block runs.
+        @param command: List of which the 2nd element is the command ID (unused)
+        @return: 'okay'
+        """
+        if self.inbound:
+            self.current_speaker, self.current_message = self.inbound.popleft()
+        else:
+            self.current_speaker = None
+            self.current_message = None
+        self.changed('current_speaker', 'current_message', 'queue_depth')
         return 'okay'
 
     #noinspection PyUnusedLocal
@@ -199,14 +809,29 @@ class ScratchCommandHandlers:
         @return: 'okay'
         """
         if self.server_connection:
-            self.server_connection.sendall('<quit>'.encode())
+            # after what is still queued; the server answers, and the reader
+            # thread then closes the connection
+            self.outgoing.append(self.codec.encode('<quit>'))
+            self.detach(shutdown=False)
+        self.outgoing.clear()
+        self.resuming = 0
         self.server_connection = None
+        self.attempt += 1 # stop connecting
+        self.connection_state = DISCONNECTED
         self.username = None
         self.room = None
+        self.keywords = []
         self.last_message = None
-        self.last_message_for = {}
+        self.last_message_for = MentionTable(self.last_message_for.capacity,
+                                             self.last_message_for.ttl)
         self.last_speaker = None
         self.message_contains_text = False
+        self.inbound.clear()
+        self.dropped_messages = 0
+        self.current_speaker = None
+        self.current_message = None
+        self.payload = PollPayload()
+        self.changed(*self.poll_fields)
         return 'okay'
 
     #noinspection PyUnusedLocal
@@ -219,45 +844,104 @@ class ScratchCommandHandlers:
         """
         # look for first poll and when received let the world know we are ready!
         if not self.first_poll_received:
-            logging.info('Scratch detected! Ready to rock and roll...')
-            print('Scratch detected! Ready to rock and roll...')
+            log.info('Scratch detected! Ready to rock and roll...')
             self.first_poll_received = True
 
-        msg = None
-        if self.server_connection:
-            read_socks, _, _ = select.select([self.server_connection], [], [], 0)
-            if len(read_socks) > 0:
-                s = read_socks[0]
-                msg = s.recv(READ_BUFFER)
-                msg = msg.decode()
-                print(msg)
-                parts = msg.split(':')
-                if parts[0] != 'Instructions' and parts[0] != self.room + ' welcomes':
-                    self.last_speaker = parts[0]
-                else:
-                    self.last_speaker = None
-                self.last_message = parts[1]
-                # look for @xyz at the beginning of the message
-                match = re.match('^@[a-zA-Z0-9_]+', self.last_message)
-                if match:
-                    recipient = match.group(0)[1:]
-                    self.last_message_for[recipient] = self.last_message.replace('@'+recipient, '')
-
-        chat_info  = ''
-        chat_info += 'connected ' + bool2str(self.server_connection) + END_OF_LINE
-        chat_info += 'username ' + parse.quote(self.username or ' ') + END_OF_LINE
-        chat_info += 'room ' + parse.quote(self.room or ' ') + END_OF_LINE
-        chat_info += 'last_speaker ' + parse.quote(self.last_speaker or ' ') + END_OF_LINE
-        chat_info += 'last_message ' + parse.quote(self.last_message or ' ') + END_OF_LINE
-        chat_info += 'contains_text ' + bool2str(self.message_contains_text) + END_OF_LINE
-        for recipient in self.last_message_for.keys():
-            chat_info += 'last_message_for/' + parse.quote(recipient) + ' ' + \
-                    parse.quote(self.last_message_for[recipient]) + END_OF_LINE
-            if recipient == self.username:
-                chat_info += 'last_message_for_me ' + \
-                        parse.quote(self.last_message_for[recipient]) + END_OF_LINE
-
-        return chat_info + 'okay'
+        self.send_queued() # no message waits longer than one poll
+        for recipient in self.last_message_for.expire():
+            self.changed_mention(recipient)
+        # messages are received by the reader thread, and only the lines
+        # of what changed were encoded again
+        return self.payload.render()
+
+    def receive(self, s, decoder):
+        """
+        Reader thread: drains the connection to the pychat server as soon
+        as messages arrive, so that none is lost between two polls, and
+        polls never wait on the network.
+        @param s: The socket connected to the pychat server
+        @param decoder: Its frame decoder
+        """
+        while True:
+            try:
+                data = s.recv(READ_BUFFER)
+            except (OSError, zlib.error, pychat_util.FrameError):
+                data = b''
+            if not self.on_data(s, decoder, data):
+                break
+        s.close()
+
+    def on_data(self, s, decoder, data):
+        """
+        Handle data received from the pychat server.
+        @param s: The connection it was received from
+        @param decoder: Its frame decoder
+        @param data: The received bytes, empty when the connection is closed
+        @return: False if the connection is not used anymore
+        """
+        try:
+            msgs = decoder.feed(data)
+        except pychat_util.FrameError:
+            data = b''
+        with self.lock:
+            if self.server_connection is not s: # reset, or connected again
+                return False
+            if not data:
+                log.warning('Server down! Connecting again...')
+                self.server_connection = None
+                self.changed('connected')
+                self.start_connecting(RECONNECTING)
+                return False
+            for msg in msgs:
+                self.handle_message(msg)
+        return True
+
+    def handle_message(self, msg):
+        """
+        Update the last message/speaker and mentions with one message
+        received from the pychat server.
+        @param msg: The decoded message, without framing
+        """
+        chat_log.info('%s', msg)
+        parts = msg.split(':', 1)
+        if len(parts) < 2:
+            # continuation of a multi-line server notice (e.g. instructions)
+            return
+        if parts[0] != 'Instructions' and parts[0] != (self.room or '') + ' welcomes':
+            self.last_speaker = parts[0]
+        else:
+            self.last_speaker = None
+        self.last_message = parts[1]
+        self.changed('last_speaker', 'last_message')
+        if self.last_speaker is not None: # not a server notice
+            if self.streams:
+                self.publish('message', {'speaker': self.last_speaker,
+                                         'message': self.last_message})
+            if len(self.inbound) == INBOUND_QUEUE: # Scratch does not keep up
+                self.inbound.popleft()
+                self.dropped_messages += 1
+            self.inbound.append((self.last_speaker, self.last_message))
+            self.changed('queue_depth', 'dropped_messages')
+        # look for @xyz at the beginning of the message
+        match = pychat_util.MENTION_RE.match(self.last_message)
+        if match:
+            recipient = match.group(1)
+            message = self.last_message.replace('@'+recipient, '')
+            for forgotten in self.last_message_for.put(recipient, message):
+                self.changed_mention(forgotten)
+            self.changed_mention(recipient)
+
+    #noinspection PyUnusedLocal
+    def poll_stats(self, command):
+        """
+        Report how often poll could return its cached response.
+        Not a Scratch block: open http://localhost:50355/poll_stats
+        @param command: unused
+        @return: poll cache and outbound batching counters
+        """
+        return 'poll_cache_hits {}{}poll_rebuilds {}{}sent_messages {}{}sent_writes {}{}'.format(
+            self.payload.hits, END_OF_LINE, self.payload.rebuilds, END_OF_LINE,
+            self.sent_messages, END_OF_LINE, self.sent_writes, END_OF_LINE)
 
     #noinspection PyUnusedLocal
     def send_cross_domain_policy(self, command):
@@ -279,5 +963,121 @@ class ScratchCommandHandlers:
     command_dict = { 'crossdomain.xml': send_cross_domain_policy,
                      'reset_all': reset_all, 'poll': poll,
                      'connect_as': connect_as, 'join_room': join_room, 'say': say, 'say_to': say_to,
-                     'check_message_contains': check_message_contains }
+                     'subscribe': subscribe, 'unsubscribe': unsubscribe,
+                     'check_message_contains': check_message_contains,
+                     'next_message': next_message, 'poll_stats': poll_stats }
+
+
+class ScratchSessions:
+    """
+    Shared bridge: serves many Scratch sessions, each with its own
+    ScratchCommandHandlers. The session id is given in the path, as in
+    /session/<id>/poll; other paths go to the default session, so that a
+    Scratch 2.0 project works unchanged. All the sessions share a few
+    multiplexed connections to the pychat server. A session without requests
+    for idle seconds (and without /events client) is dropped, as is the
+    least recently used one past max_sessions.
+    """
+
+    def __init__(self, chatserver, links=1, codec=pychat_util.DEFAULT_CODEC,
+                 idle=SESSION_IDLE, max_sessions=MAX_SESSIONS, **options):
+        """
+        @param links: Number of connections to the pychat server
+        @param idle: Seconds without requests before a session is dropped, 0 for no limit
+        @param max_sessions: Most sessions kept
+        @param options: Passed on to the ScratchCommandHandlers of each session
+        """
+        self.chatserver = chatserver
+        self.codec = codec
+        self.idle = idle
+        self.max_sessions = max_sessions
+        self.options = options
+        self.upstream = scratch_upstream.UpstreamPool(chatserver, links, codec,
+                                                      options.get('compress', False),
+                                                      CONNECT_TIMEOUT)
+        # {session_id: (ScratchCommandHandlers, last request)}, least recently used first
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def session(self, session_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.pop(session_id, None)
+            if entry is None:
+                handler = ScratchCommandHandlers(self.chatserver, self.codec, self.upstream,
+                                                 **self.options)
+            else:
+                handler = entry[0]
+            self.sessions[session_id] = (handler, now)
+            dropped = self.expire(now)
+        for old_id, old in dropped: # closing takes the lock of the session
+            log.info('Dropping session %r', old_id)
+            old.close()
+        return handler
+
+    def expire(self, now):
+        """
+        Called with the lock held.
+        @return: [(session_id, ScratchCommandHandlers)] dropped
+        """
+        dropped = []
+        while self.sessions:
+            session_id, (handler, used) = next(iter(self.sessions.items()))
+            if len(self.sessions) <= self.max_sessions:
+                if not self.idle or now - used < self.idle:
+                    break
+                if handler.streams: # still listened to
+                    self.sessions.move_to_end(session_id)
+                    self.sessions[session_id] = (handler, now)
+                    continue
+            del self.sessions[session_id]
+            dropped.append((session_id, handler))
+        return dropped
+
+    def flush(self):
+        """
+        Send what the sessions still have queued, e.g. before exiting.
+        """
+        with self.lock:
+            sessions = [handler for handler, used in self.sessions.values()]
+        for handler in sessions:
+            handler.flush()
+
+    def route(self, command):
+        """
+        @param command: List made of the path elements
+        @return: (handler of the session named in the command, the command
+                 without the session)
+        """
+        session_id, command = self.split(command)
+        return self.session(session_id), command
+
+    @staticmethod
+    def split(command):
+        """
+        @return: (session id, the command without the session)
+        """
+        if command[0] == 'session' and len(command) >= 3:
+            return parse.unquote(command[1]), command[2:]
+        return '', command
+
+    def do_command(self, command):
+        """
+        Same as ScratchCommandHandlers.do_command, for the session named
+        in the command.
+        @param command: List made of the path elements
+        @return: String to be returned to Scratch via HTTP
+        """
+        handler, command = self.route(command)
+        return handler.do_command(command)
+
+    def open_stream(self, command):
+        handler, command = self.route(command)
+        return handler.open_stream(command)
 
+    def close_stream(self, command, stream):
+        session_id, command = self.split(command)
+        with self.lock: # not created again if it was dropped meanwhile
+            entry = self.sessions.get(session_id)
+        if entry is not None:
+            entry[0].close_stream(command, stream)
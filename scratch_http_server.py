@@ -21,7 +21,10 @@ Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 """
 
 import logging
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HEARTBEAT = 15 # seconds without events before an /events client gets a comment
+RETRY = 1000 # milliseconds an EventSource waits before connecting again
 
 
 class GetHandler(BaseHTTPRequestHandler):
@@ -33,6 +36,12 @@ class GetHandler(BaseHTTPRequestHandler):
     called to process the command.
     """
 
+    # HTTP/1.1 keeps the connection open between two polls
+    protocol_version = 'HTTP/1.1'
+
+    # close idle keep-alive connections after this many seconds
+    timeout = 60
+
     # instance handle for the scratch command handler
     scratch_command_handler = None
 
@@ -54,6 +63,10 @@ class GetHandler(BaseHTTPRequestHandler):
         self.command_handler = scratch_command_handler
 
     #noinspection PyPep8Naming
+    def log_message(self, format, *args):
+        # errors of the HTTP server go to the log too, not to stderr
+        logging.getLogger('scratchat.http').info(format, *args)
+
     def do_GET(self):
         """
         Scratch2 only sends HTTP GET commands. This method processes them.
@@ -67,6 +80,13 @@ class GetHandler(BaseHTTPRequestHandler):
         # create a list containing the command and all of its parameters
         cmd_list = cmd.split('/')
 
+        # server-sent events instead of polls, for Scratch 3 and browsers:
+        # /events, or /session/<id>/events (not /say/events)
+        if cmd_list == ['events'] or (len(cmd_list) == 3 and cmd_list[0] == 'session' and
+                                      cmd_list[2] == 'events'):
+            self.send_events(cmd_list)
+            return
+
         # get the command handler method for the command and call the handler
         # cmd_list[0] contains the command. look up the command method
 
@@ -74,10 +94,9 @@ class GetHandler(BaseHTTPRequestHandler):
 
         # a "NoneType" can be returned by the command_handler
         if (s is None) or (len(s) == 0):
-            err_statement = ("do_GET: NoneType was returned " + str(cmd_list))
-            logging.info(err_statement)
-            print(err_statement)
-            return
+            logging.info("do_GET: NoneType was returned %s", cmd_list)
+            # still answer, or Scratch would wait on the kept-alive connection
+            self.send_resp('okay')
         else:
             self.send_resp(s)
 
@@ -89,41 +108,73 @@ class GetHandler(BaseHTTPRequestHandler):
         """
 
         crlf = "\r\n"
-        # http_response = str(response + crlf)
+        body = b''
+        if response != 'okay':
+            body = bytearray(response + crlf, 'UTF8')
         http_response = "HTTP/1.1 200 OK" + crlf
         http_response += "Content-Type: text/html; charset=ISO-8859-1" + crlf
-        http_response += "Content-Length" + str(len(response)) + crlf
+        # the length of the body as sent, so that the connection can be reused
+        http_response += "Content-Length: " + str(len(body)) + crlf
         http_response += "Access-Control-Allow-Origin: *" + crlf
         http_response += crlf
-        #add the response to the nonsense above
-        if response != 'okay':
-            http_response += str(response + crlf)
-        # send it out the door to Scratch
-        self.wfile.write(bytearray(http_response, 'UTF8'))
-
+        # send it out the door to Scratch, in one write
+        self.wfile.write(bytearray(http_response, 'UTF8') + body)
 
-def start_server(port, command_handler):
+    def send_events(self, cmd_list):
+        """
+        Stream the events of the session (text/event-stream) until the
+        client goes away: each message is pushed as soon as it is received,
+        instead of waiting for the next poll. A comment is sent after
+        HEARTBEAT seconds without events, so that proxies keep the
+        connection open and a client that is gone is noticed.
+        """
+        stream = self.command_handler.open_stream(cmd_list)
+        # the response has no length: it ends with the connection
+        self.close_connection = True
+        crlf = "\r\n"
+        http_response = "HTTP/1.1 200 OK" + crlf
+        http_response += "Content-Type: text/event-stream; charset=UTF-8" + crlf
+        http_response += "Cache-Control: no-cache" + crlf
+        http_response += "Connection: close" + crlf
+        http_response += "Access-Control-Allow-Origin: *" + crlf
+        http_response += crlf
+        data = bytearray(http_response, 'UTF8') + b'retry: %d\n\n' % RETRY
+        try:
+            while True:
+                self.wfile.write(data)
+                data = stream.take(HEARTBEAT) or b': heartbeat\n\n'
+        except OSError: # gone, or not reading for self.timeout seconds
+            pass
+        finally:
+            self.command_handler.close_stream(cmd_list, stream)
+
+
+def start_server(port, command_handler, host='localhost'):
     """
        This function populates class variables with essential data and
-       instantiates the HTTP Server
+       instantiates the HTTP Server.
+       Each connection is served by its own thread, so that a slow command
+       (e.g. connecting to the chat server) does not hold back the polls.
+       @param host: Address to listen on; a shared bridge serving other
+                    computers listens on all of them ('')
     """
 
     GetHandler.set_items(command_handler)
     try:
-        server = HTTPServer(('localhost', port), GetHandler)
-        print('Starting HTTP Server on port {}'.format(port))
-        print('Use <Ctrl-C> to exit the extension\n')
-        print('Please start Scratch')
+        server = ThreadingHTTPServer((host, port), GetHandler)
+        server.daemon_threads = True
+        logging.info('Starting HTTP Server on port %d', port)
+        logging.info('Use <Ctrl-C> to exit the extension\n')
+        logging.info('Please start Scratch')
     except Exception:
-        logging.debug('Exception in scratch_http_server.py: HTTP Socket may already be in use - restart Scratch')
-        print('HTTP Socket may already be in use - restart Scratch')
+        logging.error('HTTP Socket may already be in use - restart Scratch')
         raise
     try:
         #start the server
         server.serve_forever()
     except KeyboardInterrupt:
         logging.info('scratch_http_server.py: keyboard interrupt exception')
-        print('Goodbye !')
+        logging.info('Goodbye !')
         raise KeyboardInterrupt
     except Exception:
         logging.debug('scratch_http_server.py: Exception %s' % str(Exception))
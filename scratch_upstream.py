@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scratchat - multiplexed connections to the PyChat server, shared by the
+sessions of a shared bridge
+@author: Antoine Choppin
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation; either
+version 2.1 of the License, or (at your option) any later version.
+
+This library is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""
+
+import itertools, queue, socket, threading, zlib
+from pychat import pychat_util
+
+READ_BUFFER = 64 * 1024
+
+
+class Channel:
+    """
+    The stream of one session over a Link. It offers the part of the
+    socket interface used by ScratchCommandHandlers.
+    """
+
+    __slots__ = ('link', 'id', 'incoming', 'on_data', 'closed', 'timeout')
+
+    def __init__(self, link, channel_id):
+        self.link = link
+        self.id = channel_id
+        self.incoming = queue.SimpleQueue() # until start() is called
+        self.on_data = None
+        self.closed = False
+        self.timeout = None
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def sendall(self, data):
+        if self.closed:
+            raise ConnectionResetError('channel closed')
+        self.link.send(pychat_util.mux_chunk(self.id, data))
+
+    def recv(self, bufsize):
+        """
+        Blocking read, used during the handshake only.
+        """
+        try:
+            return self.incoming.get(timeout=self.timeout)
+        except queue.Empty:
+            raise socket.timeout('timed out')
+
+    def start(self, on_data):
+        """
+        From now on, received data is passed to on_data(data) by the
+        reader thread of the link (b'' when the channel is closed). When
+        on_data returns False, the channel is closed.
+        """
+        self.on_data = on_data
+        while not self.incoming.empty():
+            self.deliver(self.incoming.get())
+
+    def deliver(self, data):
+        if self.on_data is None:
+            self.incoming.put(data)
+        elif not self.on_data(data):
+            self.close()
+
+    def shutdown(self, how=socket.SHUT_RDWR):
+        self.close()
+        self.deliver(b'')
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.link.close_channel(self)
+
+
+class Link:
+    """
+    One connection to the pychat server, switched to multiplexed mode,
+    which carries the channels of many sessions.
+    """
+
+    def __init__(self, chatserver, codec=pychat_util.DEFAULT_CODEC, compress=False,
+                 timeout=None):
+        """
+        @param timeout: Seconds to connect and complete the handshake
+        """
+        self.socket = socket.create_connection((chatserver, pychat_util.PORT), timeout)
+        self.lock = threading.Lock() # one sender at a time
+        self.channels = {} # {channel_id: Channel}
+        self.next_id = itertools.count(1)
+        self.alive = True
+        # plain handshake, then ask to compress and to multiplex
+        decoder = codec.decoder()
+        msgs = []
+        while not any('Please tell us your name' in msg for msg in msgs):
+            msgs += decoder.feed(self.recv_handshake())
+        if compress:
+            self.socket.sendall(codec.encode(pychat_util.COMPRESS_COMMAND))
+            accepted, received = pychat_util.read_answer(self.socket, codec,
+                                                         pychat_util.COMPRESS_ACK)
+            if accepted:
+                self.socket = pychat_util.CompressedSocket(self.socket, received)
+        self.socket.sendall(codec.encode(pychat_util.MUX_COMMAND))
+        msgs = []
+        while pychat_util.MUX_ACK not in msgs:
+            msgs += decoder.feed(self.recv_handshake())
+        self.socket.settimeout(None)
+        self.decoder = pychat_util.MuxDecoder()
+        threading.Thread(target=self.receive, daemon=True).start()
+
+    def recv_handshake(self):
+        data = self.socket.recv(READ_BUFFER)
+        if not data:
+            raise ConnectionError('pychat server closed the connection')
+        return data
+
+    def open_channel(self):
+        channel = Channel(self, next(self.next_id))
+        self.channels[channel.id] = channel
+        self.send(pychat_util.mux_chunk(channel.id)) # the server sends the welcome
+        return channel
+
+    def close_channel(self, channel):
+        if self.channels.pop(channel.id, None) is not None and self.alive:
+            try:
+                self.send(pychat_util.mux_chunk(channel.id))
+            except OSError:
+                pass
+
+    def send(self, data):
+        with self.lock:
+            self.socket.sendall(data)
+
+    def receive(self):
+        """
+        Reader thread: dispatches the received chunks to the channels.
+        """
+        try:
+            while True:
+                data = self.socket.recv(READ_BUFFER)
+                if not data:
+                    break
+                for channel_id, payload in self.decoder.feed(data):
+                    channel = self.channels.get(channel_id)
+                    if channel is None:
+                        continue
+                    if not payload: # closed by the server
+                        self.channels.pop(channel_id, None)
+                        channel.closed = True
+                    channel.deliver(payload)
+        except (OSError, zlib.error, pychat_util.FrameError):
+            pass
+        self.alive = False
+        self.socket.close()
+        for channel in list(self.channels.values()):
+            channel.closed = True
+            channel.deliver(b'')
+        self.channels.clear()
+
+
+class UpstreamPool:
+    """
+    A few links to the pychat server, shared by all the sessions: a new
+    channel goes to the link carrying the fewest channels.
+    """
+
+    def __init__(self, chatserver, size=1, codec=pychat_util.DEFAULT_CODEC, compress=False,
+                 timeout=None):
+        self.chatserver = chatserver
+        self.size = size
+        self.codec = codec
+        self.compress = compress
+        self.timeout = timeout
+        self.links = []
+        self.lock = threading.Lock()
+
+    def open(self):
+        """
+        @return: a new Channel, used like a socket connected to the server
+        """
+        with self.lock:
+            self.links = [link for link in self.links if link.alive]
+            if len(self.links) < self.size:
+                self.links.append(Link(self.chatserver, self.codec, self.compress,
+                                       self.timeout))
+            link = min(self.links, key=lambda link: len(link.channels))
+            return link.open_channel()
@@ -21,51 +21,124 @@ License along with this library; if not, write to the Free Software
 Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 """
+import argparse
 import os
 import sys
 import logging
 import scratch_http_server
-from scratch_command_handlers import ScratchCommandHandlers
+import scratch_command_handlers
+from pychat import pychat_logging
+from scratch_command_handlers import ScratchCommandHandlers, ScratchSessions
 import time
 
+# chatty log categories: most records per second, see pychat_logging
+LOG_SAMPLE = {'scratchat.chat': 100, 'scratchat.commands': 100}
+
 
 #noinspection PyBroadException
-def scratchat(chatserver):
+def scratchat(chatserver, shared=False, links=1, bind='localhost',
+              mentions=scratch_command_handlers.MENTION_CAPACITY,
+              mention_ttl=scratch_command_handlers.MENTION_TTL, log_levels=None,
+              log_sample=LOG_SAMPLE, compress=False,
+              batch_window=scratch_command_handlers.BATCH_WINDOW,
+              stream_buffer=scratch_command_handlers.STREAM_BUFFER,
+              session_idle=scratch_command_handlers.SESSION_IDLE,
+              max_sessions=scratch_command_handlers.MAX_SESSIONS):
     """
     This is the "main" function of the program.
     It will instantiate the command handlers class.
     It will the start the HTTP server to communicate with Scratch 2.0
+    @param shared: Serve many Scratch sessions over a few multiplexed
+                   connections to the pychat server
+    @param links: Number of those connections
+    @param bind: Address the HTTP server listens on
+    @param mentions: Recipients kept for the "last message for" block
+    @param mention_ttl: Seconds a mention is kept, 0 for no limit
+    @param log_levels: {log category: level}
+    @param log_sample: {log category: most records per second}
+    @param compress: Ask the pychat server to compress the connections
+    @param batch_window: Seconds the messages said wait to be sent together
+    @param stream_buffer: Events kept for each client of /events
+    @param session_idle: Seconds without requests before a shared session is dropped
+    @param max_sessions: Most sessions kept when shared
     @return : This is the main loop and should never return
     """
     # make sure we have a log directory and if not, create it.
     if not os.path.exists('log'):
         os.makedirs('log')
 
-    # turn on logging
-    logging.basicConfig(filename='./log/scratchat_debugging.log', filemode='w', level=logging.DEBUG)
+    # turn on logging, written out by a thread of its own
+    log_listener = pychat_logging.setup(log_file='./log/scratchat_debugging.log', file_mode='w',
+                                        levels=log_levels, sample=log_sample)
     logging.info('scratchat Copyright(C) 2016 Antoine Choppin All Rights Reserved')
-    print('scratchat Copyright(C) 2016 Antoine Choppin All Rights Reserved')
 
     # tcp server port - must match that in the .s2e descriptor file
     port = 50355
 
     # instantiate the command handler
-    scratch_command_handler = ScratchCommandHandlers(chatserver)
+    if shared:
+        scratch_command_handler = ScratchSessions(chatserver, links, idle=session_idle,
+                                                  max_sessions=max_sessions,
+                                                  mention_capacity=mentions,
+                                                  mention_ttl=mention_ttl, compress=compress,
+                                                  batch_window=batch_window,
+                                                  stream_buffer=stream_buffer)
+    else:
+        scratch_command_handler = ScratchCommandHandlers(chatserver, mention_capacity=mentions,
+                                                         mention_ttl=mention_ttl, compress=compress,
+                                                         batch_window=batch_window,
+                                                         stream_buffer=stream_buffer)
 
     try:
-        scratch_http_server.start_server(port, scratch_command_handler)
+        scratch_http_server.start_server(port, scratch_command_handler, bind)
 
     except Exception:
         logging.debug('Exception in scratchat.py %s' % str(Exception))
-        return
 
     except KeyboardInterrupt:
         # give control back to the shell that started us
         logging.info('scratchat.py: keyboard interrupt exception')
-        return
+
+    finally:
+        # nothing said is lost when the bridge stops
+        scratch_command_handler.flush()
+        log_listener.stop()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python3 scratchat.py [server]", file = sys.stderr)
-        sys.exit(1)
-    scratchat(sys.argv[1])
+    parser = argparse.ArgumentParser(description='Scratch 2.0 extension for pychat')
+    parser.add_argument('server', help="pychat server")
+    parser.add_argument('--shared', action='store_true',
+                        help="serve many Scratch sessions, at /session/<id>/...")
+    parser.add_argument('--links', type=int, default=1,
+                        help="connections to the server shared by the sessions (default: %(default)s)")
+    parser.add_argument('--bind', default='localhost',
+                        help="address of the HTTP server (default: %(default)s)")
+    parser.add_argument('--mentions', type=int, default=scratch_command_handlers.MENTION_CAPACITY,
+                        help="recipients kept for \"last message for\" (default: %(default)s)")
+    parser.add_argument('--mention-ttl', type=float, default=scratch_command_handlers.MENTION_TTL,
+                        help="seconds a mention is kept, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--compress', action='store_true',
+                        help="ask the pychat server to compress the connections")
+    parser.add_argument('--batch-window', type=float,
+                        default=scratch_command_handlers.BATCH_WINDOW,
+                        help="seconds the messages said wait to be sent together, "
+                             "0 to send each at once (default: %(default)s)")
+    parser.add_argument('--stream-buffer', type=int,
+                        default=scratch_command_handlers.STREAM_BUFFER,
+                        help="events kept for a client of /events that does not keep up "
+                             "(default: %(default)s)")
+    parser.add_argument('--session-idle', type=float,
+                        default=scratch_command_handlers.SESSION_IDLE,
+                        help="with --shared, seconds without requests before a session is "
+                             "dropped, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--max-sessions', type=int,
+                        default=scratch_command_handlers.MAX_SESSIONS,
+                        help="with --shared, most sessions kept (default: %(default)s)")
+    pychat_logging.add_arguments(parser, LOG_SAMPLE)
+    args = parser.parse_args()
+    log_sample = dict(LOG_SAMPLE)
+    log_sample.update(pychat_logging.category_values(args.log_sample))
+    scratchat(args.server, args.shared, args.links, args.bind, args.mentions, args.mention_ttl,
+              pychat_logging.category_values(args.log_level), log_sample,
+              args.compress, args.batch_window, args.stream_buffer, args.session_idle,
+              args.max_sessions)